@@ -36,7 +36,7 @@ async def main():
     print(f"   个人Token数: {stats['personal_tokens']}")
     
     print(f"\n📋 Token详情:")
-    for i, token_info in enumerate(token_pool._tokens, 1):
+    for i, token_info in enumerate(token_pool.tokens, 1):
         print(f"\n   Token #{i}:")
         print(f"      名称: {token_info.name}")
         print(f"      优先级: {token_info.priority.name} ({token_info.priority.value})")
@@ -11,6 +11,7 @@ from .logging import logger
 from .config import BRIDGE_BASE_URL, WARMUP_INIT_RETRIES, WARMUP_INIT_DELAY_S
 from .bridge import initialize_once
 from .router import router
+from .sse_transform import aclose_bridge_client
 
 
 app = FastAPI(title="OpenAI Chat Completions (Warp bridge) - Streaming")
@@ -46,4 +47,9 @@ async def _on_startup():
     try:
         await asyncio.to_thread(initialize_once)
     except Exception as e:
-        logger.warning(f"[OpenAI Compat] Warmup initialize_once on startup failed: {e}") 
\ No newline at end of file
+        logger.warning(f"[OpenAI Compat] Warmup initialize_once on startup failed: {e}")
+
+
+@app.on_event("shutdown")
+async def _on_shutdown():
+    await aclose_bridge_client()
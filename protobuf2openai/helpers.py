@@ -10,6 +10,13 @@ def _get(d: Dict[str, Any], *names: str) -> Any:
     return None
 
 
+def _get2(d: Dict[str, Any], a: str, b: str) -> Any:
+    """Two-name form of _get for hot paths: no varargs tuple, no loop."""
+    if not isinstance(d, dict):
+        return None
+    return d[a] if a in d else d.get(b)
+
+
 def normalize_content_to_list(content: Any) -> List[Dict[str, Any]]:
     segments: List[Dict[str, Any]] = []
     try:
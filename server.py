@@ -553,6 +553,14 @@ def main():
     async def startup_event():
         await startup_tasks()
     
+    # 关闭时释放Token Pool的共享HTTP连接
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        from warp2protobuf.core.token_pool import aclose_token_pool
+        from warp2protobuf.warp.api_client import aclose_client
+        await aclose_token_pool()
+        await aclose_client()
+    
     # 启动服务器
     try:
         logger.info(f"启动服务器在端口 {args.port}")
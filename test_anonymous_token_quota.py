@@ -7,6 +7,7 @@
 """
 import asyncio
 import json
+import time
 import httpx
 from typing import Dict, Any, Optional
 
@@ -166,7 +167,7 @@ async def test_builtin_anonymous_token():
     
     # 获取匿名token
     anonymous_token = None
-    for token_info in pool._tokens:
+    for token_info in pool.tokens:
         if token_info.priority.name == "ANONYMOUS":
             anonymous_token = token_info
             break
@@ -179,7 +180,10 @@ async def test_builtin_anonymous_token():
     print(f"   名称: {anonymous_token.name}")
     print(f"   优先级: {anonymous_token.priority.name}")
     print(f"   Refresh Token: {anonymous_token.refresh_token[:50]}...")
-    print(f"   最后使用时间: {anonymous_token.last_used}")
+    if anonymous_token.last_used:
+        print(f"   距上次使用: {time.monotonic() - anonymous_token.last_used:.1f}s")
+    else:
+        print("   距上次使用: 从未使用")
     print(f"   失败次数: {anonymous_token.failure_count}")
     print(f"   是否活跃: {anonymous_token.is_active}")
     
@@ -6,9 +6,14 @@
 import asyncio
 import httpx
 import os
-from dotenv import load_dotenv
+from functools import lru_cache
 
-load_dotenv()
+
+@lru_cache(maxsize=1)
+def _ensure_env():
+    """按需加载 .env（只在真正读取环境变量时解析一次）"""
+    from dotenv import load_dotenv
+    load_dotenv()
 
 
 async def test_personal_token():
@@ -18,6 +23,7 @@ async def test_personal_token():
     print("=" * 80)
     
     # 从环境变量获取个人Token
+    _ensure_env()
     refresh_token = os.getenv("WARP_REFRESH_TOKEN")
     if not refresh_token:
         print("❌ 未找到WARP_REFRESH_TOKEN环境变量")
@@ -136,6 +142,7 @@ async def test_with_different_data():
     print("=" * 80)
     
     # 从环境变量获取个人Token
+    _ensure_env()
     refresh_token = os.getenv("WARP_REFRESH_TOKEN")
     if not refresh_token:
         print("❌ 未找到WARP_REFRESH_TOKEN环境变量")
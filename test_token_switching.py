@@ -144,7 +144,7 @@ async def test_last_used_detection():
         
         last_used = pool.get_last_used_token()
         if last_used:
-            print(f"✅ 检测到最后使用的token: {last_used.name} (last_used: {last_used.last_used})")
+            print(f"✅ 检测到最后使用的token: {last_used.name} (距上次使用: {time.monotonic() - last_used.last_used:.1f}s)")
             if last_used.refresh_token == token_info.refresh_token:
                 print("✅ 正确：检测到的token与使用的token一致")
             else:
@@ -8,15 +8,19 @@ Protobuf编解码API路由
 import json
 import base64
 import asyncio
-import httpx
 from typing import Any, Dict, List, Optional
 from datetime import datetime
 
 from fastapi import FastAPI, Request, HTTPException, WebSocket, WebSocketDisconnect, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
+try:  # Optional C JSON encoder for the large parsed_events payloads (pip install orjson)
+    import orjson
+except ImportError:
+    orjson = None
+
 from ..core.logging import logger
 from ..core.protobuf_utils import protobuf_to_dict, dict_to_protobuf_bytes
 from ..core.auth import get_jwt_token, refresh_jwt_if_needed, is_token_expired, get_valid_jwt, acquire_anonymous_access_token, refresh_jwt_token_with_token_info
@@ -25,6 +29,8 @@ from ..core.stream_processor import get_stream_processor, set_websocket_manager
 from ..config.models import get_all_unique_models
 from ..config.settings import CLIENT_VERSION, OS_CATEGORY, OS_NAME, OS_VERSION, WARP_URL as CONFIG_WARP_URL
 from ..core.server_message_data import decode_server_message_data, encode_server_message_data
+from ..warp.api_client import get_client, send_protobuf_to_warp_api, send_protobuf_to_warp_api_parsed
+from ..warp.sse import iter_sse_data, parse_payload_bytes
 
 
 def _encode_smd_inplace(obj: Any) -> Any:
@@ -67,6 +73,28 @@ def _decode_smd_inplace(obj: Any) -> Any:
         return [_decode_smd_inplace(x) for x in obj]
     else:
         return obj
+
+
+def _fast_json_response(data: Dict[str, Any]) -> Any:
+    """Encode a response body with orjson when available; otherwise let FastAPI serialize the dict"""
+    if orjson is not None:
+        try:
+            return Response(content=orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS), media_type="application/json")
+        except TypeError:
+            pass
+    return data
+
+
+def _dumps_event(out: Dict[str, Any]) -> str:
+    """Serialize one SSE event payload (non-ASCII kept as-is, like json.dumps(ensure_ascii=False))"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(out, option=orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            pass
+    return json.dumps(out, ensure_ascii=False)
+
+
 from ..core.schema_sanitizer import sanitize_mcp_input_schema_in_packet
 
 
@@ -379,7 +407,7 @@ async def get_packet_history(limit: int = 50):
 @app.post("/api/warp/send")
 async def send_to_warp_api(
     request: EncodeRequest, 
-    show_all_events: bool = Query(True, description="Show detailed SSE event breakdown")
+    show_all_events: bool = Query(False, description="Show detailed SSE event breakdown")
 ):
     try:
         logger.info(f"收到Warp API发送请求，消息类型: {request.message_type}")
@@ -392,7 +420,6 @@ async def send_to_warp_api(
         actual_data = _encode_smd_inplace(actual_data)
         protobuf_bytes = dict_to_protobuf_bytes(actual_data, request.message_type)
         logger.info(f"✅ JSON编码为protobuf成功: {len(protobuf_bytes)} 字节")
-        from ..warp.api_client import send_protobuf_to_warp_api
         response_text, conversation_id, task_id = await send_protobuf_to_warp_api(protobuf_bytes, show_all_events=show_all_events)
         await manager.log_packet("warp_request", actual_data, len(protobuf_bytes))
         await manager.log_packet("warp_response", {"response": response_text, "conversation_id": conversation_id, "task_id": task_id}, len(response_text.encode()))
@@ -426,7 +453,6 @@ async def send_to_warp_api_parsed(
         actual_data = _encode_smd_inplace(actual_data)
         protobuf_bytes = dict_to_protobuf_bytes(actual_data, request.message_type)
         logger.info(f"✅ JSON编码为protobuf成功: {len(protobuf_bytes)} 字节")
-        from ..warp.api_client import send_protobuf_to_warp_api_parsed
         response_text, conversation_id, task_id, parsed_events = await send_protobuf_to_warp_api_parsed(protobuf_bytes)
         parsed_events = _decode_smd_inplace(parsed_events)
         await manager.log_packet("warp_request_parsed", actual_data, len(protobuf_bytes))
@@ -440,7 +466,7 @@ async def send_to_warp_api_parsed(
                 event_type_counts[event_type] = event_type_counts.get(event_type, 0) + 1
             result["events_summary"] = event_type_counts
         logger.info(f"✅ Warp API解析调用成功，响应长度: {len(response_text)} 字符，事件数量: {len(parsed_events)}")
-        return result
+        return _fast_json_response(result)
     except Exception as e:
         import traceback
         error_details = {"error": str(e), "error_type": type(e).__name__, "traceback": traceback.format_exc(), "request_info": {"message_type": request.message_type, "json_size": len(str(actual_data)) if 'actual_data' in locals() else 0, "has_tools": "mcp_context" in (actual_data or {}), "has_history": "task_context" in (actual_data or {})}}
@@ -453,11 +479,34 @@ async def send_to_warp_api_parsed(
         raise HTTPException(500, detail=error_details)
 
 
+# Static headers for the SSE proxy; only authorization and content-length vary per request
+_SSE_PROXY_HEADERS = {
+    "accept": "text/event-stream",
+    "content-type": "application/x-protobuf",
+    "x-warp-client-version": CLIENT_VERSION,
+    "x-warp-os-category": OS_CATEGORY,
+    "x-warp-os-name": OS_NAME,
+    "x-warp-os-version": OS_VERSION,
+}
+
+
+def _proxy_event_type(event_data: Any) -> str:
+    """SSE代理事件的简要类型标签"""
+    if not isinstance(event_data, dict):
+        return "UNKNOWN_EVENT"
+    if "init" in event_data:
+        return "INITIALIZATION"
+    client_actions = event_data.get("client_actions")
+    if isinstance(client_actions, dict):
+        actions = client_actions.get("actions") or []
+        return f"CLIENT_ACTIONS({len(actions)})" if actions else "CLIENT_ACTIONS_EMPTY"
+    if "finished" in event_data:
+        return "FINISHED"
+    return "UNKNOWN_EVENT"
+
+
 @app.post("/api/warp/send_stream_sse")
 async def send_to_warp_api_stream_sse(request: EncodeRequest):
-    from fastapi.responses import StreamingResponse
-    import os as _os
-    import re as _re
     try:
         actual_data = request.get_data()
         if not actual_data:
@@ -469,157 +518,93 @@ async def send_to_warp_api_stream_sse(request: EncodeRequest):
         protobuf_bytes = dict_to_protobuf_bytes(actual_data, request.message_type)
         async def _agen():
             warp_url = CONFIG_WARP_URL
-            def _parse_payload_bytes(data_str: str):
-                s = _re.sub(r"\s+", "", data_str or "")
-                if not s:
-                    return None
-                if _re.fullmatch(r"[0-9a-fA-F]+", s or ""):
-                    try:
-                        return bytes.fromhex(s)
-                    except Exception:
-                        pass
-                pad = "=" * ((4 - (len(s) % 4)) % 4)
-                try:
-                    import base64 as _b64
-                    return _b64.urlsafe_b64decode(s + pad)
-                except Exception:
-                    try:
-                        return _b64.b64decode(s + pad)
-                    except Exception:
-                        return None
-            verify_opt = True
-            insecure_env = _os.getenv("WARP_INSECURE_TLS", "").lower()
-            if insecure_env in ("1", "true", "yes"):
-                verify_opt = False
-                logger.warning("TLS verification disabled via WARP_INSECURE_TLS for Warp API stream endpoint")
-            async with httpx.AsyncClient(http2=True, timeout=httpx.Timeout(60.0), verify=verify_opt, trust_env=True) as client:
-                # 最多尝试两次：第一次失败且为配额429时申请匿名token并重试一次
-                jwt = None
-                for attempt in range(2):
-                    if attempt == 0 or jwt is None:
-                        jwt = await get_valid_jwt()
-                    headers = {
-                        "accept": "text/event-stream",
-                        "content-type": "application/x-protobuf",
-                        "x-warp-client-version": CLIENT_VERSION,
-                        "x-warp-os-category": OS_CATEGORY,
-                        "x-warp-os-name": OS_NAME,
-                        "x-warp-os-version": OS_VERSION,
-                        "authorization": f"Bearer {jwt}",
-                        "content-length": str(len(protobuf_bytes)),
-                    }
-                    async with client.stream("POST", warp_url, headers=headers, content=protobuf_bytes) as response:
-                        if response.status_code != 200:
-                            error_text = await response.aread()
-                            error_content = error_text.decode("utf-8") if error_text else ""
-                            # 429 且包含配额信息时，尝试使用token pool中的下一个token
-                            if response.status_code == 429 and attempt == 0 and (
-                                ("No remaining quota" in error_content) or ("No AI requests remaining" in error_content)
-                            ):
-                                logger.warning("Warp API 返回 429 (配额用尽, SSE 代理)。尝试从token pool获取下一个token并重试…")
-                                try:
-                                    # 尝试从token pool获取下一个可用token
-                                    pool = await get_token_pool()
-                                    token_info = await pool.get_next_token()
-
-                                    if token_info and token_info.cached_jwt:
-                                        # 使用缓存的JWT
-                                        logger.info(f"✅ 使用token pool中的下一个token: {token_info.name} (SSE 代理)")
-                                        jwt = token_info.cached_jwt
+            # Reuse the shared Warp client (pooled HTTP/2 connection, WARP_INSECURE_TLS honoured there)
+            client = await get_client()
+            # 最多尝试两次：第一次失败且为配额429时申请匿名token并重试一次
+            jwt = None
+            for attempt in range(2):
+                if attempt == 0 or jwt is None:
+                    jwt = await get_valid_jwt()
+                headers = {**_SSE_PROXY_HEADERS, "authorization": f"Bearer {jwt}", "content-length": str(len(protobuf_bytes))}
+                async with client.stream("POST", warp_url, headers=headers, content=protobuf_bytes) as response:
+                    if response.status_code != 200:
+                        error_text = await response.aread()
+                        error_content = error_text.decode("utf-8") if error_text else ""
+                        # 429 且包含配额信息时，尝试使用token pool中的下一个token
+                        if response.status_code == 429 and attempt == 0 and (
+                            ("No remaining quota" in error_content) or ("No AI requests remaining" in error_content)
+                        ):
+                            logger.warning("Warp API 返回 429 (配额用尽, SSE 代理)。尝试从token pool获取下一个token并重试…")
+                            try:
+                                # 尝试从token pool获取下一个可用token
+                                pool = await get_token_pool()
+                                token_info = await pool.get_next_token()
+
+                                if token_info and token_info.is_jwt_valid():
+                                    # 使用缓存的JWT
+                                    logger.info(f"✅ 使用token pool中的下一个token: {token_info.name} (SSE 代理)")
+                                    jwt = token_info.last_jwt
+                                    continue
+                                elif token_info:
+                                    # 需要刷新JWT
+                                    logger.info(f"🔄 刷新token pool中的token: {token_info.name} (SSE 代理)")
+                                    token_data = await refresh_jwt_token_with_token_info(token_info)
+                                    if token_data and "access_token" in token_data:
+                                        jwt = token_data["access_token"]
+                                        logger.info(f"✅ Token刷新成功，使用新JWT重试 (SSE 代理)")
                                         continue
-                                    elif token_info:
-                                        # 需要刷新JWT
-                                        logger.info(f"🔄 刷新token pool中的token: {token_info.name} (SSE 代理)")
-                                        token_data = await refresh_jwt_token_with_token_info(token_info)
-                                        if token_data and "access_token" in token_data:
-                                            jwt = token_data["access_token"]
-                                            logger.info(f"✅ Token刷新成功，使用新JWT重试 (SSE 代理)")
-                                            continue
-
-                                    # 如果token pool中没有可用token，尝试申请匿名token作为最后手段
-                                    logger.warning("⚠️ Token pool中没有可用token，尝试申请匿名token作为后备… (SSE 代理)")
+
+                                # 如果token pool中没有可用token，尝试申请匿名token作为最后手段
+                                logger.warning("⚠️ Token pool中没有可用token，尝试申请匿名token作为后备… (SSE 代理)")
+                                new_jwt = await acquire_anonymous_access_token()
+                                if new_jwt:
+                                    jwt = new_jwt
+                                    continue
+
+                            except Exception as e:
+                                logger.error(f"❌ Token pool处理失败 (SSE 代理): {e}")
+                                # 尝试申请匿名token作为最后手段
+                                try:
                                     new_jwt = await acquire_anonymous_access_token()
                                     if new_jwt:
                                         jwt = new_jwt
                                         continue
+                                except Exception:
+                                    pass
 
-                                except Exception as e:
-                                    logger.error(f"❌ Token pool处理失败 (SSE 代理): {e}")
-                                    # 尝试申请匿名token作为最后手段
-                                    try:
-                                        new_jwt = await acquire_anonymous_access_token()
-                                        if new_jwt:
-                                            jwt = new_jwt
-                                            continue
-                                    except Exception:
-                                        pass
-
-                            logger.error(f"Warp API HTTP error {response.status_code}: {error_content[:300]}")
-                            yield f"data: {{\"error\": \"HTTP {response.status_code}\"}}\n\n"
-                            yield "data: [DONE]\n\n"
-                            return
+                        logger.error(f"Warp API HTTP error {response.status_code}: {error_content[:300]}")
+                        yield f"data: {{\"error\": \"HTTP {response.status_code}\"}}\n\n"
+                        yield "data: [DONE]\n\n"
+                        return
+                    try:
+                        logger.info(f"✅ Warp API SSE连接已建立: {warp_url}")
+                        logger.info(f"📦 请求字节数: {len(protobuf_bytes)}")
+                    except Exception:
+                        pass
+                    event_no = 0
+                    async for data in iter_sse_data(response):
+                        raw_bytes = parse_payload_bytes(data)
+                        if raw_bytes is None:
+                            continue
                         try:
-                            logger.info(f"✅ Warp API SSE连接已建立: {warp_url}")
-                            logger.info(f"📦 请求字节数: {len(protobuf_bytes)}")
+                            event_data = protobuf_to_dict(raw_bytes, "warp.multi_agent.v1.ResponseEvent")
                         except Exception:
-                            pass
-                        current_data = ""
-                        event_no = 0
-                        async for line in response.aiter_lines():
-                            if line.startswith("data:"):
-                                payload = line[5:].strip()
-                                if not payload:
-                                    continue
-                                if payload == "[DONE]":
-                                    break
-                                current_data += payload
-                                continue
-                            if (line.strip() == "") and current_data:
-                                raw_bytes = _parse_payload_bytes(current_data)
-                                current_data = ""
-                                if raw_bytes is None:
-                                    continue
-                                try:
-                                    event_data = protobuf_to_dict(raw_bytes, "warp.multi_agent.v1.ResponseEvent")
-                                except Exception:
-                                    continue
-                                def _get(d: Dict[str, Any], *names: str) -> Any:
-                                    for n in names:
-                                        if isinstance(d, dict) and n in d:
-                                            return d[n]
-                                    return None
-                                event_type = "UNKNOWN_EVENT"
-                                if isinstance(event_data, dict):
-                                    if "init" in event_data:
-                                        event_type = "INITIALIZATION"
-                                    else:
-                                        client_actions = _get(event_data, "client_actions", "clientActions")
-                                        if isinstance(client_actions, dict):
-                                            actions = _get(client_actions, "actions", "Actions") or []
-                                            event_type = f"CLIENT_ACTIONS({len(actions)})" if actions else "CLIENT_ACTIONS_EMPTY"
-                                        elif "finished" in event_data:
-                                            event_type = "FINISHED"
-                                event_no += 1
-                                try:
-                                    logger.info(f"🔄 SSE Event #{event_no}: {event_type}")
-                                except Exception:
-                                    pass
-                                out = {"event_number": event_no, "event_type": event_type, "parsed_data": event_data}
-                                try:
-                                    chunk = json.dumps(out, ensure_ascii=False)
-                                except Exception:
-                                    continue
-                                yield f"data: {chunk}\n\n"
+                            continue
+                        event_type = _proxy_event_type(event_data)
+                        event_no += 1
                         try:
-                            logger.info("="*60)
-                            logger.info("📊 SSE STREAM SUMMARY (代理)")
-                            logger.info("="*60)
-                            logger.info(f"📈 Total Events Forwarded: {event_no}")
-                            logger.info("="*60)
+                            logger.info(f"🔄 SSE Event #{event_no}: {event_type}")
                         except Exception:
                             pass
-                        yield "data: [DONE]\n\n"
-                        return
+                        out = {"event_number": event_no, "event_type": event_type, "parsed_data": event_data}
+                        try:
+                            chunk = _dumps_event(out)
+                        except Exception:
+                            continue
+                        yield f"data: {chunk}\n\n"
+                    logger.info("%s\n📊 SSE STREAM SUMMARY (代理)\n%s\n📈 Total Events Forwarded: %d\n%s", "=" * 60, "=" * 60, event_no, "=" * 60)
+                    yield "data: [DONE]\n\n"
+                    return
         return StreamingResponse(_agen(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "Connection": "keep-alive"})
     except HTTPException:
         raise
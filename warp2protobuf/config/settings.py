@@ -31,6 +31,12 @@ OS_CATEGORY = "Windows"
 OS_NAME = "Windows"
 OS_VERSION = "11 (26100)"
 
+# Ask Warp to compress the SSE stream (set WARP_ACCEPT_GZIP=0 if the server misbehaves)
+WARP_ACCEPT_GZIP = os.getenv("WARP_ACCEPT_GZIP", "1").lower() in ("1", "true", "yes")
+
+# Level of the warp_api logger (e.g. WARNING skips per-event logging and decoding on the hot path)
+WARP_LOG_LEVEL = os.getenv("WARP_LOG_LEVEL", "DEBUG").upper()
+
 # Protobuf field names for text detection
 TEXT_FIELD_NAMES = ("text", "prompt", "query", "content", "message", "input")
 PATH_HINT_BONUS = ("conversation", "query", "input", "user", "request", "delta")
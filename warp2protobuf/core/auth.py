@@ -49,64 +49,21 @@ def is_token_expired(token: str, buffer_minutes: int = 5) -> bool:
     return (expiry_time - current_time) <= buffer_time
 
 
-async def refresh_jwt_token_with_token_info(token_info: TokenInfo) -> dict:
+async def refresh_jwt_token_with_token_info(token_info: TokenInfo, min_ttl: float = 30.0) -> dict:
     """Refresh JWT token using a specific TokenInfo from the pool.
 
+    A cached JWT with at least `min_ttl` seconds left is reused, and concurrent
+    refreshes of the same token are coalesced by the pool into a single request.
+
     Args:
         token_info: TokenInfo object containing the refresh token
+        min_ttl: minimum remaining lifetime (seconds) for reusing the cached JWT
 
     Returns:
         dict: Token data with 'access_token' on success, empty dict on failure
     """
-    logger.info(f"Refreshing JWT token using {token_info.name}...")
-    payload = f"grant_type=refresh_token&refresh_token={token_info.refresh_token}".encode("utf-8")
-    headers = {
-        "x-warp-client-version": CLIENT_VERSION,
-        "x-warp-os-category": OS_CATEGORY,
-        "x-warp-os-name": OS_NAME,
-        "x-warp-os-version": OS_VERSION,
-        "content-type": "application/x-www-form-urlencoded",
-        "accept": "*/*",
-        "accept-encoding": "gzip, br",
-        "content-length": str(len(payload))
-    }
-    try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                REFRESH_URL,
-                headers=headers,
-                content=payload
-            )
-            if response.status_code == 200:
-                token_data = response.json()
-                logger.info(f"✅ Token refresh successful using {token_info.name}")
-
-                # Mark token as successful and cache JWT info
-                pool = await get_token_pool()
-                jwt = token_data.get("access_token", "")
-                if jwt:
-                    payload = decode_jwt_payload(jwt)
-                    expiry = payload.get('exp', 0) if payload else 0
-                    await pool.mark_token_success(token_info, jwt, expiry)
-
-                return token_data
-            else:
-                logger.error(f"❌ Token refresh failed ({response.status_code}) using {token_info.name}")
-                logger.error(f"Response: {response.text}")
-
-                # Mark token as failed
-                pool = await get_token_pool()
-                await pool.mark_token_failed(token_info)
-
-                return {}
-    except Exception as e:
-        logger.error(f"❌ Error refreshing token using {token_info.name}: {e}")
-
-        # Mark token as failed
-        pool = await get_token_pool()
-        await pool.mark_token_failed(token_info)
-
-        return {}
+    pool = await get_token_pool()
+    return await pool.refresh_jwt(token_info, min_ttl=min_ttl)
 
 
 async def refresh_jwt_token() -> dict:
@@ -133,8 +90,9 @@ async def refresh_jwt_token() -> dict:
             logger.error("❌ No available tokens in pool")
             break
 
-        # Try to refresh with this token
-        token_data = await refresh_jwt_token_with_token_info(token_info)
+        # Try to refresh with this token; the result is written to WARP_JWT, which
+        # check_and_refresh_token renews 15 minutes before expiry
+        token_data = await refresh_jwt_token_with_token_info(token_info, min_ttl=15 * 60)
         if token_data and "access_token" in token_data:
             return token_data
 
@@ -10,7 +10,7 @@ import os
 import shutil
 from datetime import datetime
 from logging.handlers import RotatingFileHandler
-from ..config.settings import LOGS_DIR
+from ..config.settings import LOGS_DIR, WARP_LOG_LEVEL
 
 
 def backup_existing_log():
@@ -36,7 +36,8 @@ def setup_logging():
     backup_existing_log()
     
     logger = logging.getLogger('warp_api')
-    logger.setLevel(logging.DEBUG)
+    level = logging.getLevelName(WARP_LOG_LEVEL)
+    logger.setLevel(level if isinstance(level, int) else logging.DEBUG)
     
     for handler in logger.handlers[:]:
         logger.removeHandler(handler)
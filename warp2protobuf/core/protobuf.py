@@ -18,6 +18,7 @@ from google.protobuf import descriptor_pool, descriptor_pb2
 from google.protobuf.descriptor import FieldDescriptor as FD
 from google.protobuf.message_factory import GetMessageClass
 from google.protobuf import struct_pb2
+from google.protobuf.internal import api_implementation
 
 from ..config.settings import PROTO_DIR, CLIENT_VERSION, OS_CATEGORY, OS_NAME, OS_VERSION, TEXT_FIELD_NAMES, PATH_HINT_BONUS
 from .logging import logger, log
@@ -116,6 +117,20 @@ def ensure_proto_runtime():
         raise RuntimeError(f"No .proto found under {PROTO_DIR}")
     desc = _build_descset(files, [str(PROTO_DIR)])
     _load_pool_from_descset(desc)
+    _log_proto_backend()
+
+
+def _log_proto_backend():
+    """Report which protobuf runtime decodes the SSE events.
+
+    upb/cpp parse in C; the pure-Python runtime (PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=python,
+    or a platform without a binary wheel) is an order of magnitude slower per event.
+    """
+    backend = api_implementation.Type()
+    if backend == "python":
+        logger.warning("⚠️ protobuf正在使用纯Python实现，事件解析会明显变慢；请安装带upb的protobuf wheel并取消PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION=python")
+    else:
+        logger.info(f"protobuf运行时: {backend}")
 
 
 def msg_cls(full: str):
@@ -24,20 +24,31 @@ def protobuf_to_dict(protobuf_bytes: bytes, message_type: str) -> Dict:
     
     try:
         MessageClass = msg_cls(message_type)
+    except Exception as e:
+        logger.error(f"Protobuf解码失败: {e}")
+        raise HTTPException(500, f"Protobuf解码失败: {e}")
+    return protobuf_to_dict_cls(protobuf_bytes, MessageClass)
+
+
+def protobuf_to_dict_cls(protobuf_bytes: bytes, MessageClass: Any) -> Dict:
+    """将protobuf字节转换为字典（调用方已解析好消息类，跳过按名称查找）"""
+    try:
         message = MessageClass()
         message.ParseFromString(protobuf_bytes)
-        
-        data = MessageToDict(message, preserving_proto_field_name=True)
-        
-        # 在转换阶段自动解析 server_message_data（Base64URL -> 结构化对象）
-        data = _decode_smd_inplace(data)
-        return data
+        return message_to_dict(message)
     
     except Exception as e:
         logger.error(f"Protobuf解码失败: {e}")
         raise HTTPException(500, f"Protobuf解码失败: {e}")
 
 
+def message_to_dict(message: Any) -> Dict:
+    """将已解析的protobuf消息转换为字典（不重新解析字节）"""
+    data = MessageToDict(message, preserving_proto_field_name=True)
+    # 在转换阶段自动解析 server_message_data（Base64URL -> 结构化对象）
+    return _decode_smd_inplace(data)
+
+
 
 
 
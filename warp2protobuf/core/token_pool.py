@@ -8,13 +8,17 @@ Supports personal tokens (high priority) and anonymous tokens (low priority).
 """
 import asyncio
 import base64
+import functools
+import hashlib
+import itertools
 import json
 import os
+import random
 import time
 from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
-from typing import Dict, List, Optional, Set
+from typing import Dict, Iterator, List, Optional, Tuple
 import httpx
 from dotenv import load_dotenv, set_key
 
@@ -22,6 +26,26 @@ from ..config.settings import REFRESH_TOKEN_B64, REFRESH_URL, CLIENT_VERSION, OS
 from .logging import logger
 
 
+@functools.lru_cache(maxsize=1)
+def _builtin_anon_token() -> Optional[str]:
+    """Decode the built-in anonymous refresh token once per process"""
+    decoded = base64.b64decode(REFRESH_TOKEN_B64).decode('utf-8')
+    # Extract refresh_token from "grant_type=refresh_token&refresh_token=XXX"
+    if "refresh_token=" in decoded:
+        return decoded.split("refresh_token=")[1]
+    return None
+
+
+def _jwt_exp(jwt: str) -> float:
+    """Extract the `exp` claim from a JWT payload (0.0 if it cannot be parsed)"""
+    try:
+        payload_b64 = jwt.split('.')[1]
+        payload = json.loads(base64.urlsafe_b64decode(payload_b64 + '=' * (-len(payload_b64) % 4)))
+        return float(payload.get('exp', 0))
+    except Exception:
+        return 0.0
+
+
 class TokenPriority(Enum):
     """Token priority levels"""
     ANONYMOUS = 1     # Anonymous tokens (highest priority - to save personal quota)
@@ -29,23 +53,34 @@ class TokenPriority(Enum):
     PERSONAL = 3      # Personal tokens (lowest priority - save for when anonymous fails)
 
 
-@dataclass
+# Selection order (ANONYMOUS first to save personal quota)
+_PRIORITY_ORDER = (TokenPriority.ANONYMOUS, TokenPriority.SHARED, TokenPriority.PERSONAL)
+
+
+@dataclass(slots=True)
 class TokenInfo:
     """Information about a refresh token"""
     refresh_token: str
     priority: TokenPriority
     name: str = ""
-    last_used: float = 0.0
+    last_used: float = 0.0  # time.monotonic() of last selection, only meaningful within this process
     failure_count: int = 0
     is_active: bool = True
     last_jwt: str = ""
     last_jwt_expiry: float = 0.0
+    retry_after: float = 0.0  # time.monotonic() until which the token is cooling down after a failure
+    use_count: int = 0  # Selections by either path; get_next_token_excluding picks the least-used token
     
     def __post_init__(self):
         if not self.name:
-            # Generate a short name from token hash
-            token_hash = hash(self.refresh_token) % 10000
-            self.name = f"{self.priority.name}_{token_hash:04d}"
+            # Generate a short, restart-stable name from the token digest
+            short = hashlib.blake2b(self.refresh_token.encode(), digest_size=3).hexdigest()
+            self.name = f"{self.priority.name}_{short}"
+
+    def is_jwt_valid(self, skew: float = 30.0) -> bool:
+        """Whether the cached JWT is still valid for at least `skew` seconds"""
+        # last_jwt_expiry is the JWT `exp` claim, i.e. a wall-clock epoch timestamp
+        return bool(self.last_jwt) and (self.last_jwt_expiry - skew) > time.time()
 
 
 class TokenPool:
@@ -62,47 +97,80 @@ class TokenPool:
     
     def __init__(self):
         self._tokens: List[TokenInfo] = []
+        # Immutable view of _tokens, swapped on every add so readers can iterate without copying
+        self._tokens_snapshot: Tuple[TokenInfo, ...] = ()
+        self._by_token: Dict[str, TokenInfo] = {}  # refresh_token -> TokenInfo
+        self._by_priority: Dict[TokenPriority, List[TokenInfo]] = {
+            priority: [] for priority in TokenPriority
+        }
         self._lock = asyncio.Lock()
-        self._current_index: Dict[TokenPriority, int] = {
-            TokenPriority.PERSONAL: 0,
-            TokenPriority.SHARED: 0,
-            TokenPriority.ANONYMOUS: 0,
+        # Read-mostly snapshot of active tokens per priority; rebuilt only on mutation
+        # so the selection hot path never has to take the lock.
+        self._active_by_priority: Dict[TokenPriority, Tuple[TokenInfo, ...]] = {
+            priority: () for priority in TokenPriority
         }
-        self._last_used_index: Dict[TokenPriority, int] = {
-            TokenPriority.PERSONAL: 0,
-            TokenPriority.SHARED: 0,
-            TokenPriority.ANONYMOUS: 0,
+        # Persistent round-robin iterator per priority bucket; reset only when membership changes
+        self._cycles: Dict[TokenPriority, Iterator[TokenInfo]] = {
+            priority: itertools.cycle(bucket) for priority, bucket in self._by_priority.items()
         }
-        self._failed_tokens: Set[str] = set()
+        self._last_used: Optional[TokenInfo] = None  # Most recently selected token
+        self._use_count_max = 1 << 16  # Halve all use counts once one reaches this
+        # Rotating scan offset for get_next_token_excluding, indexed by priority.value, so equal use counts spread out
+        self._excluding_start: List[int] = [0] * (max(p.value for p in TokenPriority) + 1)
+        self._refresh_inflight: Dict[str, asyncio.Future] = {}  # refresh_token -> in-flight refresh
+        self._http: Optional[httpx.AsyncClient] = None  # Shared client for refresh requests
         self._max_failures = 3  # Max failures before marking token as inactive
+        self._backoff_base = 1.0  # Seconds; cooldown after the k-th failure is base * 2**k + jitter
+        self._backoff_max = 60.0
+        self._next_recovery = float("inf")  # Earliest retry_after among deactivated tokens
+        self._token_available = asyncio.Event()  # Set while at least one token is active
         self._initialized = False
     
     async def initialize(self):
         """Initialize token pool from environment variables"""
+        # Double-checked: skip the lock entirely once initialization has been published
+        if self._initialized:
+            return
         async with self._lock:
             if self._initialized:
                 return
             
             logger.info("🔄 Initializing token pool...")
-
-            # Load anonymous/fallback token (highest priority - to save personal quota)
-            anonymous_token = self._load_anonymous_token()
-            if anonymous_token:
-                self._add_token_internal(anonymous_token, TokenPriority.ANONYMOUS)
-
-            # Load shared tokens (medium priority)
-            shared_tokens = self._load_shared_tokens()
-            for token in shared_tokens:
-                self._add_token_internal(token, TokenPriority.SHARED)
-
-            # Load personal tokens (lowest priority - save for when anonymous fails)
-            personal_tokens = self._load_personal_tokens()
-            for token in personal_tokens:
-                self._add_token_internal(token, TokenPriority.PERSONAL)
+            self._get_http()
+
+            # Anonymous first (to save personal quota), then shared, then personal
+            sources = (
+                (self._load_anonymous_token_list, TokenPriority.ANONYMOUS),
+                (self._load_shared_tokens, TokenPriority.SHARED),
+                (self._load_personal_tokens, TokenPriority.PERSONAL),
+            )
+            for loader, priority in sources:
+                self._add_tokens_bulk(loader(), priority)
             
+            self._rebuild_active_snapshot()
+            # Published last, after the snapshot is in place, so lock-free readers never
+            # observe an initialized pool with empty buckets
             self._initialized = True
-            self._log_pool_status()
+            status = self._format_pool_status()
+
+        logger.info(status)
     
+    def _get_http(self) -> httpx.AsyncClient:
+        """Return the shared HTTP client, creating it on first use"""
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+                timeout=httpx.Timeout(30.0),
+            )
+        return self._http
+
+    async def aclose(self):
+        """Close the shared HTTP client"""
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
     def _load_personal_tokens(self) -> List[str]:
         """Load personal refresh tokens from environment"""
         tokens = []
@@ -115,13 +183,17 @@ class TokenPool:
         
         # Multiple personal tokens (comma-separated)
         personal_tokens_str = os.getenv("WARP_PERSONAL_TOKENS")
-        if personal_tokens_str:
-            for token in personal_tokens_str.split(','):
-                token = token.strip()
-                if token and token not in tokens:
-                    tokens.append(token)
-            if personal_tokens_str.strip():
-                logger.info(f"✅ Loaded {len(personal_tokens_str.split(','))} personal tokens from WARP_PERSONAL_TOKENS")
+        raw = personal_tokens_str.split(',') if personal_tokens_str else []
+        seen = set(tokens)
+        added = 0
+        for token in raw:
+            token = token.strip()
+            if token and token not in seen:
+                tokens.append(token)
+                seen.add(token)
+                added += 1
+        if added:
+            logger.info(f"✅ Loaded {added} personal tokens from WARP_PERSONAL_TOKENS")
         
         return tokens
     
@@ -130,13 +202,15 @@ class TokenPool:
         tokens = []
         
         shared_tokens_str = os.getenv("WARP_SHARED_TOKENS")
-        if shared_tokens_str:
-            for token in shared_tokens_str.split(','):
-                token = token.strip()
-                if token:
-                    tokens.append(token)
-            if shared_tokens_str.strip():
-                logger.info(f"✅ Loaded {len(tokens)} shared tokens from WARP_SHARED_TOKENS")
+        raw = shared_tokens_str.split(',') if shared_tokens_str else []
+        seen = set()
+        for token in raw:
+            token = token.strip()
+            if token and token not in seen:
+                tokens.append(token)
+                seen.add(token)
+        if tokens:
+            logger.info(f"✅ Loaded {len(tokens)} shared tokens from WARP_SHARED_TOKENS")
         
         return tokens
     
@@ -150,37 +224,78 @@ class TokenPool:
         
         # Fall back to built-in token
         try:
-            decoded = base64.b64decode(REFRESH_TOKEN_B64).decode('utf-8')
-            # Extract refresh_token from "grant_type=refresh_token&refresh_token=XXX"
-            if "refresh_token=" in decoded:
-                token = decoded.split("refresh_token=")[1]
+            token = _builtin_anon_token()
+            if token:
                 logger.info("✅ Loaded built-in anonymous token")
                 return token
         except Exception as e:
             logger.warning(f"⚠️ Failed to decode built-in token: {e}")
         
         return None
+
+    def _load_anonymous_token_list(self) -> List[str]:
+        """Load the anonymous/fallback token as a (possibly empty) list"""
+        token = self._load_anonymous_token()
+        return [token] if token else []
     
     def _add_token_internal(self, refresh_token: str, priority: TokenPriority):
         """Add a token to the pool (internal, no lock)"""
         # Check if token already exists
-        for token_info in self._tokens:
-            if token_info.refresh_token == refresh_token:
-                logger.debug(f"Token already in pool: {token_info.name}")
-                return
+        existing = self._by_token.get(refresh_token)
+        if existing is not None:
+            logger.debug(f"Token already in pool: {existing.name}")
+            return
         
         token_info = TokenInfo(
             refresh_token=refresh_token,
             priority=priority
         )
         self._tokens.append(token_info)
+        self._tokens_snapshot = tuple(self._tokens)
+        self._by_token[refresh_token] = token_info
+        self._by_priority[priority].append(token_info)
+        self._cycles[priority] = itertools.cycle(self._by_priority[priority])
         logger.debug(f"➕ Added token: {token_info.name} (priority: {priority.name})")
+
+    def _add_tokens_bulk(self, refresh_tokens: List[str], priority: TokenPriority):
+        """Add several tokens of one priority, rebuilding the bucket's cycle once (internal, no lock)"""
+        new_infos = []
+        for refresh_token in refresh_tokens:
+            existing = self._by_token.get(refresh_token)
+            if existing is not None:
+                logger.debug(f"Token already in pool: {existing.name}")
+                continue
+            token_info = TokenInfo(refresh_token=refresh_token, priority=priority)
+            self._by_token[refresh_token] = token_info
+            new_infos.append(token_info)
+            logger.debug(f"➕ Added token: {token_info.name} (priority: {priority.name})")
+
+        if new_infos:
+            self._tokens.extend(new_infos)
+            self._tokens_snapshot = tuple(self._tokens)
+            self._by_priority[priority].extend(new_infos)
+            self._cycles[priority] = itertools.cycle(self._by_priority[priority])
+    
+    def _rebuild_active_snapshot(self):
+        """Rebuild the per-priority tuples of active tokens (internal, call under lock after mutation)"""
+        self._active_by_priority = {
+            priority: tuple(t for t in bucket if t.is_active)
+            for priority, bucket in self._by_priority.items()
+        }
+        # Wake anyone blocked in get_next_token_blocking, or make them wait again
+        if any(self._active_by_priority.values()):
+            self._token_available.set()
+        else:
+            self._token_available.clear()
     
     async def add_token(self, refresh_token: str, priority: TokenPriority = TokenPriority.SHARED):
         """Add a new token to the pool"""
         async with self._lock:
             self._add_token_internal(refresh_token, priority)
-            self._log_pool_status()
+            self._rebuild_active_snapshot()
+            status = self._format_pool_status()
+
+        logger.info(status)
     
     async def get_next_token(self) -> Optional[TokenInfo]:
         """
@@ -192,38 +307,108 @@ class TokenPool:
         if not self._initialized:
             await self.initialize()
         
-        async with self._lock:
-            # Try each priority level in order (ANONYMOUS first to save personal quota)
-            for priority in [TokenPriority.ANONYMOUS, TokenPriority.SHARED, TokenPriority.PERSONAL]:
-                token = self._get_token_by_priority(priority)
+        now = time.monotonic()
+        if now >= self._next_recovery:
+            self._reactivate_cooled_tokens(now)
+
+        # Lock-free: reads the immutable per-priority snapshot
+        # Try each priority level in order (ANONYMOUS first to save personal quota);
+        # tokens still cooling down are only used when nothing else is ready
+        for ready_only in (True, False):
+            for priority in _PRIORITY_ORDER:
+                token = self._get_token_by_priority(priority, now if ready_only else None)
                 if token:
-                    token.last_used = time.time()
+                    self._record_use(token, now)
                     logger.debug(f"🎯 Selected token: {token.name} (priority: {priority.name})")
                     return token
 
-            logger.error("❌ No available tokens in pool!")
-            return None
+        logger.error("❌ No available tokens in pool!")
+        return None
     
-    def _get_token_by_priority(self, priority: TokenPriority) -> Optional[TokenInfo]:
-        """Get next token of specific priority using round-robin"""
-        # Get all active tokens of this priority
-        priority_tokens = [
-            t for t in self._tokens 
-            if t.priority == priority and t.is_active and t.refresh_token not in self._failed_tokens
-        ]
-        
-        if not priority_tokens:
+    async def get_next_token_blocking(self, timeout: Optional[float] = None) -> Optional[TokenInfo]:
+        """
+        Like get_next_token, but waits for a token to become available instead of returning None.
+
+        Args:
+            timeout: maximum seconds to wait, or None to wait indefinitely
+
+        Returns:
+            TokenInfo, or None if the timeout expired
+        """
+        if not self._initialized:
+            await self.initialize()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._token_available.is_set():
+                token = await self.get_next_token()
+                if token:
+                    return token
+
+            # Also wake up when the earliest backoff elapses, since cooled-down tokens are
+            # reactivated lazily on the selection path rather than by a timer
+            now = time.monotonic()
+            wait = self._next_recovery - now
+            if deadline is not None:
+                if now >= deadline:
+                    return None
+                wait = min(wait, deadline - now)
+            try:
+                await asyncio.wait_for(self._token_available.wait(), None if wait == float("inf") else max(wait, 0.0))
+            except asyncio.TimeoutError:
+                self._reactivate_cooled_tokens(time.monotonic())
+
+    def _get_token_by_priority(self, priority: TokenPriority, now: Optional[float] = None) -> Optional[TokenInfo]:
+        """Get next token of specific priority using round-robin (skipping cooling-down tokens if `now` is given)"""
+        if not self._active_by_priority[priority]:
             return None
         
-        # Round-robin selection
-        current_idx = self._current_index[priority]
-        token = priority_tokens[current_idx % len(priority_tokens)]
-        
-        # Update index for next call
-        self._current_index[priority] = (current_idx + 1) % len(priority_tokens)
-        
-        return token
+        # Round-robin selection: advance the bucket's cycle past inactive tokens
+        cycle = self._cycles[priority]
+        for _ in range(len(self._by_priority[priority])):
+            token = next(cycle)
+            if token.is_active and (now is None or token.retry_after <= now):
+                return token
+        return None
+
+    def _record_use(self, token: TokenInfo, now: float):
+        """Stamp a selected token and count the selection (no awaits, so safe without the lock)"""
+        token.use_count += 1
+        if token.use_count >= self._use_count_max:
+            # Halve every counter so old usage decays and counts stay bounded
+            for t in self._tokens_snapshot:
+                t.use_count >>= 1
+        token.last_used = now
+        self._last_used = token
+
+    def _reactivate_cooled_tokens(self, now: float):
+        """Reactivate deactivated tokens whose backoff has elapsed (no awaits, so safe without the lock)"""
+        next_recovery = float("inf")
+        reactivated = []
+        for token_info in self._tokens_snapshot:
+            if token_info.is_active:
+                continue
+            if token_info.retry_after <= now:
+                token_info.is_active = True
+                reactivated.append(token_info.name)
+            else:
+                next_recovery = min(next_recovery, token_info.retry_after)
+        self._next_recovery = next_recovery
+
+        if reactivated:
+            self._rebuild_active_snapshot()
+            for name in reactivated:
+                logger.info(f"🔄 Token cooldown elapsed, reactivated: {name}")
     
+    @property
+    def tokens(self) -> Tuple[TokenInfo, ...]:
+        """All pooled tokens, as an immutable snapshot"""
+        return self._tokens_snapshot
+
+    def get_token_info(self, refresh_token: str) -> Optional[TokenInfo]:
+        """Look up a pooled token by its refresh_token string"""
+        return self._by_token.get(refresh_token)
+
     def get_last_used_token(self) -> Optional[TokenInfo]:
         """
         Get the most recently used token.
@@ -231,17 +416,7 @@ class TokenPool:
         Returns:
             TokenInfo if available, None if no tokens have been used
         """
-        if not self._tokens:
-            return None
-
-        # Find the token with the most recent last_used timestamp
-        most_recent = None
-        for token in self._tokens:
-            if token.last_used > 0:
-                if most_recent is None or token.last_used > most_recent.last_used:
-                    most_recent = token
-
-        return most_recent
+        return self._last_used
 
     async def get_next_token_excluding(self, exclude_token: Optional[str] = None) -> Optional[TokenInfo]:
         """
@@ -257,97 +432,194 @@ class TokenPool:
         if not self._initialized:
             await self.initialize()
 
-        async with self._lock:
-            # Try each priority level in order (ANONYMOUS first to save personal quota)
-            for priority in [TokenPriority.ANONYMOUS, TokenPriority.SHARED, TokenPriority.PERSONAL]:
-                # Get all active tokens of this priority, excluding the specified token
-                priority_tokens = [
-                    t for t in self._tokens
-                    if t.priority == priority
-                    and t.is_active
-                    and t.refresh_token not in self._failed_tokens
-                    and (exclude_token is None or t.refresh_token != exclude_token)
-                ]
-
-                if priority_tokens:
-                    # Use round-robin within same priority
-                    if priority not in self._last_used_index:
-                        self._last_used_index[priority] = 0
-
-                    idx = self._last_used_index[priority] % len(priority_tokens)
-                    token = priority_tokens[idx]
-                    self._last_used_index[priority] = (idx + 1) % len(priority_tokens)
-
-                    token.last_used = time.time()
-                    logger.debug(f"🎯 Selected token (excluding {exclude_token[:20] if exclude_token else 'none'}...): {token.name} (priority: {priority.name})")
-                    return token
+        now = time.monotonic()
+        if now >= self._next_recovery:
+            self._reactivate_cooled_tokens(now)
+
+        # Lock-free: reads the immutable per-priority snapshot
+        # Try each priority level in order (ANONYMOUS first to save personal quota)
+        for priority in _PRIORITY_ORDER:
+            # Least-used active token of this priority other than the excluded one,
+            # preferring tokens that are not cooling down after a recent failure.
+            # Single pass over the snapshot, no filtered copies.
+            # The scan starts at a rotating offset: ties keep the first token seen, so this
+            # preserves the round-robin spread among equally used tokens.
+            bucket = self._active_by_priority[priority]
+            n = len(bucket)
+            start = self._excluding_start[priority.value] % n if n else 0
+            self._excluding_start[priority.value] = start + 1
+            token = None
+            token_ready = False
+            for k in range(n):
+                t = bucket[(start + k) % n]
+                if t.refresh_token == exclude_token:
+                    continue
+                t_ready = t.retry_after <= now
+                if token is None or (t_ready, -t.use_count) > (token_ready, -token.use_count):
+                    token, token_ready = t, t_ready
+
+            if token:
+                self._record_use(token, now)
+                logger.debug(f"🎯 Selected token (excluding {exclude_token[:20] if exclude_token else 'none'}...): {token.name} (priority: {priority.name})")
+                return token
 
-            logger.error("❌ No other available tokens in pool!")
-            return None
+        logger.error("❌ No other available tokens in pool!")
+        return None
+
+    async def refresh_jwt(self, token_info: TokenInfo, min_ttl: float = 30.0) -> Dict:
+        """
+        Refresh the JWT for a token, coalescing concurrent refreshes of the same token.
+
+        If the token's last JWT is still valid for at least `min_ttl` seconds it is
+        returned without a network request. Callers that arrive while a refresh for
+        the same refresh_token is in flight await that result instead of issuing a
+        duplicate request.
+
+        Args:
+            token_info: token to refresh
+            min_ttl: minimum remaining lifetime for the cached JWT to be reused;
+                pass 0 or less to always request a new JWT
+
+        Returns:
+            Token data dict with 'access_token' on success, empty dict on failure
+        """
+        if min_ttl > 0 and token_info.is_jwt_valid(skew=min_ttl):
+            logger.debug(f"♻️ Reusing cached JWT for {token_info.name}")
+            return {"access_token": token_info.last_jwt}
+
+        key = token_info.refresh_token
+        # Check-and-register has no await in between, so it is atomic on the event loop
+        inflight = self._refresh_inflight.get(key)
+        if inflight is not None:
+            logger.debug(f"⏳ Waiting for in-flight refresh of {token_info.name}")
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._refresh_inflight[key] = future
+        try:
+            token_data = await self._request_jwt(token_info)
+            future.set_result(token_data)
+            return token_data
+        finally:
+            if not future.done():
+                future.set_result({})
+            self._refresh_inflight.pop(key, None)
+
+    async def _request_jwt(self, token_info: TokenInfo) -> Dict:
+        """Exchange a refresh token for a JWT at REFRESH_URL and record the outcome"""
+        logger.info(f"Refreshing JWT token using {token_info.name}...")
+        payload = f"grant_type=refresh_token&refresh_token={token_info.refresh_token}".encode("utf-8")
+        headers = {
+            "x-warp-client-version": CLIENT_VERSION,
+            "x-warp-os-category": OS_CATEGORY,
+            "x-warp-os-name": OS_NAME,
+            "x-warp-os-version": OS_VERSION,
+            "content-type": "application/x-www-form-urlencoded",
+            "accept": "*/*",
+            "accept-encoding": "gzip, br",
+            "content-length": str(len(payload))
+        }
+        try:
+            response = await self._get_http().post(
+                REFRESH_URL,
+                headers=headers,
+                content=payload
+            )
+            if response.status_code != 200:
+                logger.error(f"❌ Token refresh failed ({response.status_code}) using {token_info.name}")
+                logger.error(f"Response: {response.text}")
+                await self.mark_token_failed(token_info)
+                return {}
+            token_data = response.json()
+        except Exception as e:
+            logger.error(f"❌ Error refreshing token using {token_info.name}: {e}")
+            await self.mark_token_failed(token_info)
+            return {}
+
+        logger.info(f"✅ Token refresh successful using {token_info.name}")
+
+        # Mark token as successful and cache JWT info (expiry is derived from the JWT)
+        jwt = token_data.get("access_token", "")
+        if jwt:
+            await self.mark_token_success(token_info, jwt)
+
+        return token_data
 
     async def mark_token_failed(self, token_info: TokenInfo):
         """Mark a token as failed and potentially deactivate it"""
+        # Mutate under the lock, log after releasing it
         async with self._lock:
             token_info.failure_count += 1
-
-            if token_info.failure_count >= self._max_failures:
-                token_info.is_active = False
-                self._failed_tokens.add(token_info.refresh_token)
-                logger.warning(f"⚠️ Token deactivated after {self._max_failures} failures: {token_info.name}")
-            else:
-                logger.warning(f"⚠️ Token failure {token_info.failure_count}/{self._max_failures}: {token_info.name}")
+            count = token_info.failure_count
+            # Exponential backoff with jitter before the token is tried again
+            wait = min(self._backoff_max, self._backoff_base * 2 ** count + random.uniform(0, self._backoff_base))
+            token_info.retry_after = time.monotonic() + wait
+            deactivated = count >= self._max_failures
+
+            if deactivated:
+                if token_info.is_active:
+                    token_info.is_active = False
+                    self._rebuild_active_snapshot()
+                self._next_recovery = min(self._next_recovery, token_info.retry_after)
+
+        if deactivated:
+            logger.warning(f"⚠️ Token deactivated after {count} failures, retry in {wait:.1f}s: {token_info.name}")
+        else:
+            logger.warning(f"⚠️ Token failure {count}/{self._max_failures}, cooling down {wait:.1f}s: {token_info.name}")
     
     async def mark_token_success(self, token_info: TokenInfo, jwt: str = "", jwt_expiry: float = 0.0):
         """Mark a token as successful and reset failure count"""
         async with self._lock:
             token_info.failure_count = 0
-            if token_info.refresh_token in self._failed_tokens:
-                self._failed_tokens.remove(token_info.refresh_token)
+            token_info.retry_after = 0.0
+            if not token_info.is_active:
+                token_info.is_active = True
+                self._rebuild_active_snapshot()
             
             if jwt:
                 token_info.last_jwt = jwt
-                token_info.last_jwt_expiry = jwt_expiry
+                token_info.last_jwt_expiry = jwt_expiry or _jwt_exp(jwt)
     
     async def get_pool_stats(self) -> Dict:
         """Get statistics about the token pool"""
         async with self._lock:
+            # Single pass: [total, active] per priority
+            totals = {priority: [0, 0] for priority in TokenPriority}
+            active_all = 0
+            for t in self._tokens:
+                slot = totals[t.priority]
+                slot[0] += 1
+                if t.is_active:
+                    slot[1] += 1
+                    active_all += 1
+
             stats = {
                 "total_tokens": len(self._tokens),
-                "active_tokens": sum(1 for t in self._tokens if t.is_active),
-                "failed_tokens": len(self._failed_tokens),
-                "by_priority": {}
-            }
-
-            for priority in TokenPriority:
-                priority_tokens = [t for t in self._tokens if t.priority == priority]
-                active_count = sum(1 for t in priority_tokens if t.is_active)
-                stats["by_priority"][priority.name] = {
-                    "total": len(priority_tokens),
-                    "active": active_count,
-                    "inactive": len(priority_tokens) - active_count
+                "active_tokens": active_all,
+                "failed_tokens": len(self._tokens) - active_all,
+                "by_priority": {
+                    priority.name: {"total": total, "active": active, "inactive": total - active}
+                    for priority, (total, active) in totals.items()
                 }
+            }
 
             # Add convenience keys for direct access
-            stats["personal_tokens"] = stats["by_priority"].get("PERSONAL", {}).get("active", 0)
-            stats["shared_tokens"] = stats["by_priority"].get("SHARED", {}).get("active", 0)
-            stats["anonymous_tokens"] = stats["by_priority"].get("ANONYMOUS", {}).get("active", 0)
+            stats["personal_tokens"] = totals[TokenPriority.PERSONAL][1]
+            stats["shared_tokens"] = totals[TokenPriority.SHARED][1]
+            stats["anonymous_tokens"] = totals[TokenPriority.ANONYMOUS][1]
 
             return stats
     
-    def _log_pool_status(self):
-        """Log current pool status"""
-        total = len(self._tokens)
-        active = sum(1 for t in self._tokens if t.is_active)
+    def _format_pool_status(self) -> str:
+        """Build the pool status line (call under lock, log after releasing it)"""
+        # The active snapshot is rebuilt on every mutation, so its sizes are the active counts
+        active_counts = [(p.name, len(self._active_by_priority[p]))
+                         for p in _PRIORITY_ORDER]
+        active = sum(count for _, count in active_counts)
 
-        by_priority = {}
         # Show in priority order (ANONYMOUS first)
-        for priority in [TokenPriority.ANONYMOUS, TokenPriority.SHARED, TokenPriority.PERSONAL]:
-            count = sum(1 for t in self._tokens if t.priority == priority and t.is_active)
-            if count > 0:
-                by_priority[priority.name] = count
-
-        priority_str = ", ".join(f"{k}: {v}" for k, v in by_priority.items())
-        logger.info(f"📊 Token Pool: {active}/{total} active tokens (优先级: {priority_str})")
+        priority_str = ", ".join(f"{name}: {count}" for name, count in active_counts if count > 0)
+        return f"📊 Token Pool: {active}/{len(self._tokens)} active tokens (优先级: {priority_str})"
 
     async def health_check(self) -> Dict:
         """
@@ -356,63 +628,73 @@ class TokenPool:
         Returns:
             Dict with health check results
         """
-        async with self._lock:
-            results = {
-                "timestamp": time.time(),
-                "total_tokens": len(self._tokens),
-                "healthy_tokens": 0,
-                "unhealthy_tokens": 0,
-                "tokens": []
-            }
+        # Build the report from the immutable snapshot; momentary staleness is acceptable
+        snapshot = self._tokens_snapshot
+        now = time.time()
+        now_mono = time.monotonic()  # last_used is monotonic; report it as an age, not a timestamp
+
+        results = {
+            "timestamp": now,
+            "total_tokens": len(snapshot),
+            "healthy_tokens": 0,
+            "unhealthy_tokens": 0,
+            "tokens": []
+        }
 
-            for token_info in self._tokens:
-                is_healthy = token_info.is_active and token_info.refresh_token not in self._failed_tokens
-
-                token_status = {
-                    "name": token_info.name,
-                    "priority": token_info.priority.name,
-                    "is_active": token_info.is_active,
-                    "is_healthy": is_healthy,
-                    "failure_count": token_info.failure_count,
-                    "last_used": token_info.last_used,
-                    "has_cached_jwt": bool(token_info.last_jwt),
-                }
+        for token_info in snapshot:
+            is_healthy = token_info.is_active
+
+            token_status = {
+                "name": token_info.name,
+                "priority": token_info.priority.name,
+                "is_active": token_info.is_active,
+                "is_healthy": is_healthy,
+                "failure_count": token_info.failure_count,
+                "seconds_since_last_use": now_mono - token_info.last_used if token_info.last_used else None,
+                "has_cached_jwt": bool(token_info.last_jwt),
+            }
 
-                if token_info.last_jwt_expiry > 0:
-                    time_until_expiry = token_info.last_jwt_expiry - time.time()
-                    token_status["jwt_expires_in"] = max(0, time_until_expiry)
+            if token_info.last_jwt_expiry > 0:
+                time_until_expiry = token_info.last_jwt_expiry - now
+                token_status["jwt_expires_in"] = max(0, time_until_expiry)
 
-                results["tokens"].append(token_status)
+            results["tokens"].append(token_status)
 
-                if is_healthy:
-                    results["healthy_tokens"] += 1
-                else:
-                    results["unhealthy_tokens"] += 1
+            if is_healthy:
+                results["healthy_tokens"] += 1
+            else:
+                results["unhealthy_tokens"] += 1
 
-            return results
+        return results
 
     async def recover_failed_tokens(self):
         """
         Attempt to recover failed tokens by resetting their failure count.
         This can be called periodically to give failed tokens another chance.
         """
+        recovered_names = []
+        status = None
         async with self._lock:
-            recovered = 0
             for token_info in self._tokens:
                 if not token_info.is_active and token_info.failure_count >= self._max_failures:
                     # Reset failure count and reactivate
                     token_info.failure_count = 0
+                    token_info.retry_after = 0.0
                     token_info.is_active = True
-                    if token_info.refresh_token in self._failed_tokens:
-                        self._failed_tokens.remove(token_info.refresh_token)
-                    recovered += 1
-                    logger.info(f"🔄 Recovered token: {token_info.name}")
+                    recovered_names.append(token_info.name)
+
+            if recovered_names:
+                self._next_recovery = float("inf")
+                self._rebuild_active_snapshot()
+                status = self._format_pool_status()
 
-            if recovered > 0:
-                logger.info(f"✅ Recovered {recovered} failed tokens")
-                self._log_pool_status()
+        for name in recovered_names:
+            logger.info(f"🔄 Recovered token: {name}")
+        if recovered_names:
+            logger.info(f"✅ Recovered {len(recovered_names)} failed tokens")
+            logger.info(status)
 
-            return recovered
+        return len(recovered_names)
 
 
 # Global token pool instance
@@ -427,3 +709,11 @@ async def get_token_pool() -> TokenPool:
         await _token_pool.initialize()
     return _token_pool
 
+
+
+async def aclose_token_pool():
+    """Close the global token pool's HTTP client, if a pool was ever created"""
+    global _token_pool
+    if _token_pool is not None:
+        await _token_pool.aclose()
+        _token_pool = None
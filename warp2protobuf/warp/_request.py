@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Warp API请求辅助模块
+
+从token pool选择JWT，并在429/500时切换token重试，供api_client中的发送函数共用。
+"""
+import importlib.util
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Mapping, Optional, Tuple
+
+import httpx
+
+from ..core.logging import logger
+from ..core.auth import get_valid_jwt, acquire_anonymous_access_token, refresh_jwt_token_with_token_info
+from ..core.token_pool import get_token_pool
+from ..config.settings import CLIENT_VERSION, OS_CATEGORY, OS_NAME, OS_VERSION, WARP_ACCEPT_GZIP
+
+
+# httpx decodes br only when a brotli implementation is installed
+_HAS_BROTLI = any(importlib.util.find_spec(m) is not None for m in ("brotli", "brotlicffi"))
+
+
+# Static request headers; only authorization and content-length vary per request
+_BASE_HEADERS: Mapping[str, str] = {
+    "accept": "text/event-stream",
+    "content-type": "application/x-protobuf",
+    "x-warp-client-version": CLIENT_VERSION,
+    "x-warp-os-category": OS_CATEGORY,
+    "x-warp-os-name": OS_NAME,
+    "x-warp-os-version": OS_VERSION,
+    # httpx transparently decompresses the stream according to Content-Encoding
+    "accept-encoding": ("gzip, br" if _HAS_BROTLI else "gzip") if WARP_ACCEPT_GZIP else "identity",
+}
+
+# Markers in a 429 body that mean the token's quota is used up (vs. plain rate limiting)
+_QUOTA_RE = re.compile(r"No remaining quota|No AI requests remaining")
+
+# Error bodies are only logged and matched for quota messages; don't buffer more than this
+_ERROR_BODY_LIMIT = 8192
+
+
+async def _select_initial_jwt(mode: str = "") -> Tuple[str, Optional[str]]:
+    """从token pool获取首个请求使用的JWT，返回 (jwt, refresh_token)"""
+    pool = await get_token_pool()
+    token_info = await pool.get_next_token()
+    if not token_info:
+        # Fallback to old method if pool is empty
+        jwt = await get_valid_jwt()
+        logger.warning(f"⚠️ Token pool为空，使用环境变量中的JWT{mode}")
+        return jwt, None
+
+    # 检查JWT是否有效，如果无效则刷新
+    if token_info.is_jwt_valid(skew=120):
+        # JWT有效且未过期（至少还有2分钟）
+        logger.info(f"🎯 使用token pool中的token{mode}: {token_info.name} (优先级: {token_info.priority.name}, 使用缓存JWT)")
+        return token_info.last_jwt, token_info.refresh_token
+
+    # JWT无效或即将过期，需要刷新
+    logger.info(f"🔄 刷新token pool中的token{mode}: {token_info.name}")
+    # Same margin as the check above, otherwise the pool returns the near-expiry JWT unchanged
+    token_data = await refresh_jwt_token_with_token_info(token_info, min_ttl=120)
+    if token_data and "access_token" in token_data:
+        logger.info(f"✅ Token刷新成功{mode}: {token_info.name}")
+        return token_data["access_token"], token_info.refresh_token
+
+    logger.error(f"❌ Token刷新失败，使用环境变量中的JWT{mode}")
+    return await get_valid_jwt(), token_info.refresh_token
+
+
+async def _log_pool_stats(pool, mode: str, level: int):
+    """记录token pool状态"""
+    pool_stats = await pool.get_pool_stats()
+    logger.log(level, f"📊 Token pool状态{mode}: 总数={pool_stats['total_tokens']}, 活跃={pool_stats['active_tokens']}, 匿名={pool_stats['anonymous_tokens']}, 个人={pool_stats['personal_tokens']}")
+
+
+async def _rotate_after_quota_error(current_token_refresh: Optional[str], mode: str) -> Tuple[Optional[str], Optional[str]]:
+    """429配额用尽时从token pool获取下一个token（排除当前失败的token），返回 (jwt, refresh_token)"""
+    pool = await get_token_pool()
+
+    # 显示当前token pool状态（仅DEBUG；轮换全部失败时会再报告一次）
+    if logger.isEnabledFor(logging.DEBUG):
+        await _log_pool_stats(pool, mode, logging.DEBUG)
+
+    # 如果current_token_refresh为None，尝试获取最后使用的token
+    if current_token_refresh is None:
+        last_used = pool.get_last_used_token()
+        if last_used:
+            current_token_refresh = last_used.refresh_token
+            logger.info(f"🔍 检测到最后使用的token{mode}: {last_used.name} (上次使用: {time.monotonic() - last_used.last_used:.1f}s前)")
+        else:
+            logger.warning(f"⚠️ 无法检测到最后使用的token{mode}")
+    else:
+        logger.info("🔍 当前使用的token%s: %.20s...", mode, current_token_refresh)
+
+    logger.info("🔄 尝试获取下一个token%s (排除: %.20s...)", mode, current_token_refresh)
+    token_info = await pool.get_next_token_excluding(current_token_refresh)
+    logger.info(f"🔍 get_next_token_excluding返回{mode}: {token_info.name if token_info else 'None'}")
+
+    if not token_info:
+        # 没有其他token了，尝试申请新的匿名token
+        logger.warning("⚠️ Token pool中没有其他可用token，尝试申请新的匿名token…")
+        try:
+            new_jwt = await acquire_anonymous_access_token()
+            if new_jwt:
+                logger.info(f"✅ 成功申请新的匿名token{mode}")
+                return new_jwt, None  # New anonymous token
+        except Exception as anon_err:
+            logger.error(f"❌ 申请匿名token失败: {anon_err}")
+        logger.error("❌ 所有token尝试失败")
+        await _log_pool_stats(pool, mode, logging.ERROR)
+        return None, None
+
+    if token_info.is_jwt_valid():
+        # 使用缓存的JWT
+        logger.info(f"✅ 使用token pool中的下一个token{mode}: {token_info.name}")
+        return token_info.last_jwt, token_info.refresh_token
+
+    # 需要刷新JWT
+    logger.info(f"🔄 刷新token pool中的token{mode}: {token_info.name}")
+    token_data = await refresh_jwt_token_with_token_info(token_info)
+    if token_data and "access_token" in token_data:
+        logger.info(f"✅ Token刷新成功，使用新JWT重试{mode}")
+        return token_data["access_token"], token_info.refresh_token
+
+    # 刷新失败，尝试申请匿名token作为最后手段
+    logger.warning(f"⚠️ Token pool中没有可用token，尝试申请匿名token作为后备…{mode}")
+    new_jwt = await acquire_anonymous_access_token()
+    if new_jwt:
+        return new_jwt, current_token_refresh
+    await _log_pool_stats(pool, mode, logging.ERROR)
+    return None, None
+
+
+async def _rotate_after_server_error(current_token_refresh: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """500错误时切换到下一个token，返回 (jwt, refresh_token)"""
+    pool = await get_token_pool()
+
+    # 如果current_token_refresh为None，尝试获取最后使用的token
+    if current_token_refresh is None:
+        last_used = pool.get_last_used_token()
+        if last_used:
+            current_token_refresh = last_used.refresh_token
+            logger.info(f"🔍 检测到最后使用的token: {last_used.name}")
+
+    # 获取下一个token（排除当前失败的token）
+    token_info = await pool.get_next_token_excluding(current_token_refresh)
+    if not token_info:
+        return None, None
+
+    logger.info(f"🔄 切换到token: {token_info.name}")
+    # A 500 may mean a bad JWT, so always fetch a new one instead of the cached JWT
+    token_data = await refresh_jwt_token_with_token_info(token_info, min_ttl=0)
+    if token_data and "access_token" in token_data:
+        logger.info(f"✅ 使用新token重试")
+        return token_data["access_token"], token_info.refresh_token
+    return None, None
+
+
+async def _read_error_body(response: httpx.Response, limit: int = _ERROR_BODY_LIMIT) -> bytes:
+    """读取错误响应体的前limit字节，避免缓冲任意大小的错误内容"""
+    chunks = []
+    total = 0
+    async for chunk in response.aiter_bytes(4096):
+        chunks.append(chunk)
+        total += len(chunk)
+        if total >= limit:
+            break
+    return b"".join(chunks)[:limit]
+
+
+@asynccontextmanager
+async def _post_with_token_rotation(
+    client: httpx.AsyncClient, warp_url: str, protobuf_bytes: bytes, mode: str = ""
+) -> AsyncIterator[Tuple[Optional[httpx.Response], Optional[str]]]:
+    """
+    POST protobuf数据到Warp API，必要时切换token重试一次。
+
+    产出 (response, error)：成功时response为200的流式响应且error为None；
+    失败时response为None，error为可直接返回给调用方的错误消息。
+    """
+    # 最多尝试两次：第一次失败且为配额429/500时切换token并重试一次
+    jwt, current_token_refresh = await _select_initial_jwt(mode)
+    content_length = str(len(protobuf_bytes))
+
+    for attempt in range(2):
+        headers = {**_BASE_HEADERS, "authorization": f"Bearer {jwt}", "content-length": content_length}
+        async with client.stream("POST", warp_url, headers=headers, content=protobuf_bytes) as response:
+            if response.status_code == 200:
+                logger.info(f"✅ 收到HTTP {response.status_code}响应{mode}")
+                yield response, None
+                return
+
+            error_text = await _read_error_body(response)
+            error_content = error_text.decode('utf-8', errors='replace') if error_text else "No error content"
+
+            # 记录详细的错误信息
+            logger.error(f"❌ Warp API返回错误状态码: {response.status_code}")
+            logger.error("   错误内容: %.500s", error_content)
+            logger.error("   响应头: %r", response.headers)
+            logger.error(f"   请求大小: {len(protobuf_bytes)} 字节")
+            logger.error(f"   尝试次数: {attempt + 1}/2")
+
+            new_jwt = None
+            if attempt == 0:
+                # 检测配额耗尽错误并在第一次失败时尝试使用token pool中的下一个token
+                if response.status_code == 429 and _QUOTA_RE.search(error_content):
+                    logger.warning(f"⚠️ WARP API 返回 429 (配额用尽)。尝试从token pool获取下一个token并重试…{mode}")
+                    try:
+                        new_jwt, new_refresh = await _rotate_after_quota_error(current_token_refresh, mode)
+                    except Exception as e:
+                        logger.error(f"❌ Token pool处理失败{mode}: {e}")
+                # 特殊处理500错误 - 可能是token问题，尝试切换token
+                elif response.status_code == 500:
+                    logger.warning("⚠️ WARP API 返回 500 (服务器错误)。尝试切换到下一个token重试…")
+                    try:
+                        new_jwt, new_refresh = await _rotate_after_server_error(current_token_refresh)
+                    except Exception as e:
+                        logger.error(f"❌ 切换token失败: {e}")
+
+            if new_jwt:
+                jwt, current_token_refresh = new_jwt, new_refresh
+                continue
+
+            # 其他错误、切换失败或第二次失败
+            logger.error(f"WARP API HTTP ERROR{mode} {response.status_code}: {error_content}")
+            yield None, f"❌ Warp API Error (HTTP {response.status_code}): {error_content}"
+            return
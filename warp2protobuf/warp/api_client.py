@@ -5,56 +5,166 @@ Warp API客户端模块
 
 处理与Warp API的通信，包括protobuf数据发送和SSE响应解析。
 """
+import asyncio
+import functools
+import io
+import logging
+import reprlib
 import httpx
 import os
-import base64
-import binascii
-import time
-from typing import Optional, Any, Dict
+from typing import Optional, AsyncIterator, Dict, Iterator, List, Tuple
 from urllib.parse import urlparse
 import socket
+import sys
+import traceback
+
+from google.protobuf import json_format
+from google.protobuf.message import DecodeError
+
+try:  # Optional C JSON encoder for the DEBUG event dump (pip install orjson)
+    import orjson
+except ImportError:
+    orjson = None
 
 from ..core.logging import logger
-from ..core.protobuf_utils import protobuf_to_dict
-from ..core.auth import get_valid_jwt, acquire_anonymous_access_token
-from ..core.token_pool import get_token_pool
+from ..core.protobuf import ensure_proto_runtime, msg_cls
+from ..core.protobuf_utils import message_to_dict
 from ..config.settings import WARP_URL as CONFIG_WARP_URL
+from ._request import _post_with_token_rotation
+from .sse import iter_sse_data, parse_payload_bytes
 
 
-def _get(d: Dict[str, Any], *names: str) -> Any:
-    """Return the first matching key value (camelCase/snake_case tolerant)."""
-    for name in names:
-        if name in d:
-            return d[name]
-    return None
+# Shared client so consecutive requests reuse the pooled HTTP/2 connection to Warp
+_CLIENT: Optional[httpx.AsyncClient] = None
+_CLIENT_LOCK = asyncio.Lock()
+
+
+async def get_client() -> httpx.AsyncClient:
+    """Return the shared Warp API client, creating it on first use"""
+    global _CLIENT
+    if _CLIENT is not None and not _CLIENT.is_closed:
+        return _CLIENT
+    async with _CLIENT_LOCK:
+        if _CLIENT is None or _CLIENT.is_closed:
+            verify_opt = True
+            insecure_env = os.getenv("WARP_INSECURE_TLS", "").lower()
+            if insecure_env in ("1", "true", "yes"):
+                verify_opt = False
+                logger.warning("TLS verification disabled via WARP_INSECURE_TLS for Warp API client")
+            _CLIENT = httpx.AsyncClient(
+                http2=True,
+                timeout=httpx.Timeout(60.0),
+                verify=verify_opt,
+                trust_env=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0),
+            )
+    return _CLIENT
+
+
+async def aclose_client():
+    """Close the shared Warp API client"""
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+        _CLIENT = None
+
+
+# Bounded repr for the DEBUG event dump, so its cost does not grow with event size
+_EVENT_REPR = reprlib.Repr()
+_EVENT_REPR.maxlevel = 8
+_EVENT_REPR.maxdict = 8
+_EVENT_REPR.maxlist = 4
+_EVENT_REPR.maxstring = 80
+
+# Length cap for the orjson-rendered DEBUG event dump
+_EVENT_DUMP_LIMIT = 512
+
+
+def _format_event_for_debug(event_data: dict) -> str:
+    """Render a parsed event for the DEBUG dump: compact JSON via orjson when installed, else a bounded repr"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(event_data, option=orjson.OPT_NON_STR_KEYS)[:_EVENT_DUMP_LIMIT].decode("utf-8", "ignore")
+        except TypeError:
+            pass
+    return _EVENT_REPR.repr(event_data)
+
+# Separator line for the multi-line summary/exception log records
+_RULE = "=" * 60
+
+
+def _log_client_exception(e: BaseException, mode: str, warp_url: str, request_size: int):
+    """以单条日志记录发送过程中的异常（含traceback）"""
+    logger.error(
+        "%s\nWARP API CLIENT EXCEPTION%s\n%s\nException Type: %s\nException Message: %s\n"
+        "Request URL: %s\nRequest Size: %s\nPython Traceback:\n%s\n%s",
+        _RULE, mode, _RULE, type(e).__name__, e, warp_url, request_size, traceback.format_exc().rstrip(), _RULE,
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _response_event_cls():
+    """Resolve the ResponseEvent message class once, instead of per SSE event"""
+    ensure_proto_runtime()
+    return msg_cls("warp.multi_agent.v1.ResponseEvent")
+
+
+# ClientAction oneof case -> event type label used in logs
+_ACTION_LABELS = {
+    "create_task": "CREATE_TASK",
+    "append_to_message_content": "APPEND_CONTENT",
+    "add_messages_to_task": "ADD_MESSAGE",
+}
+
+
+_ACTION_KEYS = frozenset(_ACTION_LABELS)
+
+# Wire tags (field_number << 3 | LEN) of ResponseEvent.init (1) and ResponseEvent.client_actions (2)
+_STATEFUL_EVENT_TAGS = (b"\x0a", b"\x12")
+
+
+@functools.lru_cache(maxsize=256)
+def _client_actions_label(action_types: Tuple[str, ...]) -> str:
+    """Build (once) the CLIENT_ACTIONS(...) label for a sequence of action types.
+
+    Streams repeat the same few action combinations, so every event of a kind
+    shares one label string instead of formatting and keeping its own copy in
+    parsed_events.
+    """
+    return sys.intern(f"CLIENT_ACTIONS({', '.join(action_types)})")
+
+
+def _event_type_from_msg(msg) -> str:
+    """Determine the type of a parsed ResponseEvent message for logging"""
+    kind = msg.WhichOneof("type")
+    if kind == "init":
+        return "INITIALIZATION"
+    if kind == "client_actions":
+        actions = msg.client_actions.actions
+        if not actions:
+            return "CLIENT_ACTIONS_EMPTY"
+        return _client_actions_label(tuple(_ACTION_LABELS.get(a.WhichOneof("action"), "UNKNOWN_ACTION") for a in actions))
+    if kind == "finished":
+        return "FINISHED"
+    return "UNKNOWN_EVENT"
 
 
 def _get_event_type(event_data: dict) -> str:
     """Determine the type of SSE event for logging"""
     if "init" in event_data:
         return "INITIALIZATION"
-    client_actions = _get(event_data, "client_actions", "clientActions")
+    # Dicts come from MessageToDict(preserving_proto_field_name=True), so keys are always snake_case
+    client_actions = event_data.get("client_actions")
     if isinstance(client_actions, dict):
-        actions = _get(client_actions, "actions", "Actions") or []
+        actions = client_actions.get("actions") or []
         if not actions:
             return "CLIENT_ACTIONS_EMPTY"
         
-        action_types = []
-        for action in actions:
-            if _get(action, "create_task", "createTask") is not None:
-                action_types.append("CREATE_TASK")
-            elif _get(action, "append_to_message_content", "appendToMessageContent") is not None:
-                action_types.append("APPEND_CONTENT")
-            elif _get(action, "add_messages_to_task", "addMessagesToTask") is not None:
-                action_types.append("ADD_MESSAGE")
-            elif _get(action, "tool_call", "toolCall") is not None:
-                action_types.append("TOOL_CALL")
-            elif _get(action, "tool_response", "toolResponse") is not None:
-                action_types.append("TOOL_RESPONSE")
-            else:
-                action_types.append("UNKNOWN_ACTION")
-        
-        return f"CLIENT_ACTIONS({', '.join(action_types)})"
+        # Each action carries exactly one oneof key, so the intersection has at most one element
+        return _client_actions_label(tuple(
+            _ACTION_LABELS.get(next(iter(_ACTION_KEYS & action.keys()), None), "UNKNOWN_ACTION")
+            for action in actions
+        ))
     elif "finished" in event_data:
         return "FINISHED"
     else:
@@ -62,12 +172,13 @@ def _get_event_type(event_data: dict) -> str:
 
 
 async def send_protobuf_to_warp_api(
-    protobuf_bytes: bytes, show_all_events: bool = True
+    protobuf_bytes: bytes, show_all_events: bool = False
 ) -> tuple[str, Optional[str], Optional[str]]:
     """发送protobuf数据到Warp API并获取响应"""
     try:
         logger.info(f"发送 {len(protobuf_bytes)} 字节到Warp API")
-        logger.info(f"数据包前32字节 (hex): {protobuf_bytes[:32].hex()}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("数据包前32字节 (hex): %s", protobuf_bytes[:32].hex())
         
         warp_url = CONFIG_WARP_URL
         
@@ -75,301 +186,151 @@ async def send_protobuf_to_warp_api(
         
         conversation_id = None
         task_id = None
-        complete_response = []
-        all_events = []
+        complete_response = io.StringIO()
         event_count = 0
         
-        verify_opt = True
-        insecure_env = os.getenv("WARP_INSECURE_TLS", "").lower()
-        if insecure_env in ("1", "true", "yes"):
-            verify_opt = False
-            logger.warning("TLS verification disabled via WARP_INSECURE_TLS for Warp API client")
-
-        async with httpx.AsyncClient(http2=True, timeout=httpx.Timeout(60.0), verify=verify_opt, trust_env=True) as client:
-            # 最多尝试两次：第一次失败且为配额429时申请匿名token并重试一次
-            current_token_refresh = None  # Track which refresh token is being used
-            current_token_info = None  # Track current TokenInfo object
-
-            # 第一次请求：从token pool获取token
-            if True:  # Always use token pool
-                pool = await get_token_pool()
-                current_token_info = await pool.get_next_token()
-                if current_token_info:
-                    # 检查JWT是否有效，如果无效则刷新
-                    if current_token_info.last_jwt and current_token_info.last_jwt_expiry > time.time() + 120:
-                        # JWT有效且未过期（至少还有2分钟）
-                        jwt = current_token_info.last_jwt
-                        logger.info(f"🎯 使用token pool中的token: {current_token_info.name} (优先级: {current_token_info.priority.name}, 使用缓存JWT)")
-                    else:
-                        # JWT无效或即将过期，需要刷新
-                        logger.info(f"🔄 刷新token pool中的token: {current_token_info.name}")
-                        from ..core.auth import refresh_jwt_token_with_token_info
-                        token_data = await refresh_jwt_token_with_token_info(current_token_info)
-                        if token_data and "access_token" in token_data:
-                            jwt = token_data["access_token"]
-                            logger.info(f"✅ Token刷新成功: {current_token_info.name}")
-                        else:
-                            logger.error(f"❌ Token刷新失败，使用环境变量中的JWT")
-                            jwt = await get_valid_jwt()
-
-                    current_token_refresh = current_token_info.refresh_token
-                else:
-                    # Fallback to old method if pool is empty
-                    jwt = await get_valid_jwt()
-                    logger.warning("⚠️ Token pool为空，使用环境变量中的JWT")
-
-            for attempt in range(2):
-                headers = {
-                    "accept": "text/event-stream",
-                    "content-type": "application/x-protobuf", 
-                    "x-warp-client-version": "v0.2025.08.06.08.12.stable_02",
-                    "x-warp-os-category": "Windows",
-                    "x-warp-os-name": "Windows", 
-                    "x-warp-os-version": "11 (26100)",
-                    "authorization": f"Bearer {jwt}",
-                    "content-length": str(len(protobuf_bytes)),
-                }
-                async with client.stream("POST", warp_url, headers=headers, content=protobuf_bytes) as response:
-                    if response.status_code != 200:
-                        error_text = await response.aread()
-                        error_content = error_text.decode('utf-8') if error_text else "No error content"
-
-                        # 记录详细的错误信息
-                        logger.error(f"❌ Warp API返回错误状态码: {response.status_code}")
-                        logger.error(f"   错误内容: {error_content[:500]}")
-                        logger.error(f"   响应头: {dict(response.headers)}")
-                        logger.error(f"   请求大小: {len(protobuf_bytes)} 字节")
-                        logger.error(f"   尝试次数: {attempt + 1}/2")
-
-                        # 检测配额耗尽错误并在第一次失败时尝试使用token pool中的下一个token
-                        if response.status_code == 429 and attempt == 0 and (
-                            ("No remaining quota" in error_content) or ("No AI requests remaining" in error_content)
-                        ):
-                            logger.warning("⚠️ WARP API 返回 429 (配额用尽)。尝试从token pool获取下一个token并重试…")
-                            try:
-                                # 尝试从token pool获取下一个可用token（排除当前失败的token）
-                                pool = await get_token_pool()
-
-                                # 显示当前token pool状态
-                                pool_stats = await pool.get_pool_stats()
-                                logger.info(f"📊 Token pool状态: 总数={pool_stats['total_tokens']}, 活跃={pool_stats['active_tokens']}, 匿名={pool_stats['anonymous_tokens']}, 个人={pool_stats['personal_tokens']}")
-
-                                # 如果current_token_refresh为None，尝试获取最后使用的token
-                                if current_token_refresh is None:
-                                    last_used = pool.get_last_used_token()
-                                    if last_used:
-                                        current_token_refresh = last_used.refresh_token
-                                        logger.info(f"🔍 检测到最后使用的token: {last_used.name} (last_used={last_used.last_used})")
-                                    else:
-                                        logger.warning("⚠️ 无法检测到最后使用的token")
-                                else:
-                                    logger.info(f"🔍 当前使用的token: {current_token_refresh[:20]}...")
-
-                                logger.info(f"🔄 尝试获取下一个token (排除: {current_token_refresh[:20] if current_token_refresh else 'None'}...)")
-                                token_info = await pool.get_next_token_excluding(current_token_refresh)
-                                logger.info(f"🔍 get_next_token_excluding返回: {token_info.name if token_info else 'None'}")
-
-                                if not token_info:
-                                    # 没有其他token了，尝试申请新的匿名token
-                                    logger.warning("⚠️ Token pool中没有其他可用token，尝试申请新的匿名token…")
-                                    try:
-                                        new_jwt = await acquire_anonymous_access_token()
-                                        if new_jwt:
-                                            logger.info("✅ 成功申请新的匿名token")
-                                            jwt = new_jwt
-                                            current_token_refresh = None  # New anonymous token
-                                            continue
-                                    except Exception as anon_err:
-                                        logger.error(f"❌ 申请匿名token失败: {anon_err}")
-
-                                    logger.error("❌ 所有token尝试失败")
-                                    logger.error(f"WARP API HTTP ERROR {response.status_code}: {error_content}")
-                                    return f"❌ Warp API Error (HTTP {response.status_code}): {error_content}", None, None
-
-                                if token_info and token_info.last_jwt:
-                                    # 使用缓存的JWT
-                                    logger.info(f"✅ 使用token pool中的下一个token: {token_info.name}")
-                                    jwt = token_info.last_jwt
-                                    current_token_refresh = token_info.refresh_token  # Track current token
-                                    continue
-                                elif token_info:
-                                    # 需要刷新JWT
-                                    logger.info(f"🔄 刷新token pool中的token: {token_info.name}")
-                                    from ..core.auth import refresh_jwt_token_with_token_info
-                                    token_data = await refresh_jwt_token_with_token_info(token_info)
-                                    if token_data and "access_token" in token_data:
-                                        jwt = token_data["access_token"]
-                                        current_token_refresh = token_info.refresh_token  # Track current token
-                                        logger.info(f"✅ Token刷新成功，使用新JWT重试")
-                                        continue
-
-                            except Exception as e:
-                                logger.error(f"❌ Token pool处理失败: {e}")
-
-                            # 如果到这里，说明所有尝试都失败了
-                            logger.error(f"WARP API HTTP ERROR {response.status_code}: {error_content}")
-                            return f"❌ Warp API Error (HTTP {response.status_code}): {error_content}", None, None
-
-                        # 特殊处理500错误 - 可能是token问题，尝试切换token
-                        if response.status_code == 500 and attempt == 0:
-                            logger.warning("⚠️ WARP API 返回 500 (服务器错误)。尝试切换到下一个token重试…")
-                            try:
-                                pool = await get_token_pool()
-
-                                # 如果current_token_refresh为None，尝试获取最后使用的token
-                                if current_token_refresh is None:
-                                    last_used = pool.get_last_used_token()
-                                    if last_used:
-                                        current_token_refresh = last_used.refresh_token
-                                        logger.info(f"🔍 检测到最后使用的token: {last_used.name}")
-
-                                # 获取下一个token（排除当前失败的token）
-                                token_info = await pool.get_next_token_excluding(current_token_refresh)
-
-                                if token_info:
-                                    logger.info(f"🔄 切换到token: {token_info.name}")
-                                    current_token_refresh = token_info.refresh_token  # 更新当前token
-                                    from ..core.auth import refresh_jwt_token_with_token_info
-                                    token_data = await refresh_jwt_token_with_token_info(token_info)
-                                    if token_data and "access_token" in token_data:
-                                        jwt = token_data["access_token"]
-                                        logger.info(f"✅ 使用新token重试")
-                                        continue
-                            except Exception as e:
-                                logger.error(f"❌ 切换token失败: {e}")
-
-                        # 其他错误或第二次失败
-                        logger.error(f"WARP API HTTP ERROR {response.status_code}: {error_content}")
-                        return f"❌ Warp API Error (HTTP {response.status_code}): {error_content}", None, None
-                    
-                    logger.info(f"✅ 收到HTTP {response.status_code}响应")
-                    logger.info("开始处理SSE事件流...")
-                    
-                    import re as _re
-                    def _parse_payload_bytes(data_str: str):
-                        s = _re.sub(r"\s+", "", data_str or "")
-                        if not s:
-                            return None
-                        if _re.fullmatch(r"[0-9a-fA-F]+", s or ""):
-                            try:
-                                return bytes.fromhex(s)
-                            except Exception:
-                                pass
-                        pad = "=" * ((4 - (len(s) % 4)) % 4)
-                        try:
-                            import base64 as _b64
-                            return _b64.urlsafe_b64decode(s + pad)
-                        except Exception:
-                            try:
-                                return _b64.b64decode(s + pad)
-                            except Exception:
-                                return None
-                    
-                    current_data = ""
-                    
-                    async for line in response.aiter_lines():
-                        if line.startswith("data:"):
-                            payload = line[5:].strip()
-                            if not payload:
-                                continue
-                            if payload == "[DONE]":
-                                logger.info("收到[DONE]标记，结束处理")
-                                break
-                            current_data += payload
-                            continue
-                        
-                        if (line.strip() == "") and current_data:
-                            raw_bytes = _parse_payload_bytes(current_data)
-                            current_data = ""
-                            if raw_bytes is None:
-                                logger.debug("跳过无法解析的SSE数据块（非hex/base64或不完整）")
-                                continue
-                            try:
-                                event_data = protobuf_to_dict(raw_bytes, "warp.multi_agent.v1.ResponseEvent")
-                            except Exception as parse_error:
-                                logger.debug(f"解析事件失败，跳过: {str(parse_error)[:100]}")
-                                continue
-                            event_count += 1
-                            
-                            def _get(d: Dict[str, Any], *names: str) -> Any:
-                                for n in names:
-                                    if isinstance(d, dict) and n in d:
-                                        return d[n]
-                                return None
-                            
-                            event_type = _get_event_type(event_data)
-                            if show_all_events:
-                                all_events.append({"event_number": event_count, "event_type": event_type, "raw_data": event_data})
-                            logger.info(f"🔄 Event #{event_count}: {event_type}")
-                            if show_all_events:
-                                logger.info(f"   📋 Event data: {str(event_data)}...")
-                            
-                            if "init" in event_data:
-                                init_data = event_data["init"]
-                                conversation_id = init_data.get("conversation_id", conversation_id)
-                                task_id = init_data.get("task_id", task_id)
-                                logger.info(f"会话初始化: {conversation_id}")
-                                client_actions = _get(event_data, "client_actions", "clientActions")
-                                if isinstance(client_actions, dict):
-                                    actions = _get(client_actions, "actions", "Actions") or []
-                                    for i, action in enumerate(actions):
-                                        logger.info(f"   🎯 Action #{i+1}: {list(action.keys())}")
-                                        append_data = _get(action, "append_to_message_content", "appendToMessageContent")
-                                        if isinstance(append_data, dict):
-                                            message = append_data.get("message", {})
-                                            agent_output = _get(message, "agent_output", "agentOutput") or {}
-                                            text_content = agent_output.get("text", "")
-                                            if text_content:
-                                                complete_response.append(text_content)
-                                                logger.info(f"   📝 Text Fragment: {text_content[:100]}...")
-                                        messages_data = _get(action, "add_messages_to_task", "addMessagesToTask")
-                                        if isinstance(messages_data, dict):
-                                            messages = messages_data.get("messages", [])
-                                            task_id = messages_data.get("task_id", messages_data.get("taskId", task_id))
-                                            for j, message in enumerate(messages):
-                                                logger.info(f"   📨 Message #{j+1}: {list(message.keys())}")
-                                                if _get(message, "agent_output", "agentOutput") is not None:
-                                                    agent_output = _get(message, "agent_output", "agentOutput") or {}
-                                                    text_content = agent_output.get("text", "")
-                                                    if text_content:
-                                                        complete_response.append(text_content)
-                                                        logger.info(f"   📝 Complete Message: {text_content[:100]}...")
-                    
-                    full_response = "".join(complete_response)
-                    logger.info("="*60)
-                    logger.info("📊 SSE STREAM SUMMARY")
-                    logger.info("="*60)
-                    logger.info(f"📈 Total Events Processed: {event_count}")
-                    logger.info(f"🆔 Conversation ID: {conversation_id}")
-                    logger.info(f"🆔 Task ID: {task_id}")
-                    logger.info(f"📝 Response Length: {len(full_response)} characters")
-                    logger.info("="*60)
-                    if full_response:
-                        logger.info(f"✅ Stream processing completed successfully")
-                        return full_response, conversation_id, task_id
-                    else:
-                        logger.warning("⚠️ No text content received in response")
-                        return "Warning: No response content received", conversation_id, task_id
+        client = await get_client()
+        async with _post_with_token_rotation(client, warp_url, protobuf_bytes) as (response, error):
+            if error is not None:
+                return error, None, None
+
+            logger.info("开始处理SSE事件流...")
+            # Resolve log levels once per stream instead of per event/action
+            log_info = logger.isEnabledFor(logging.INFO)
+            log_debug = logger.isEnabledFor(logging.DEBUG)
+
+            async for data in iter_sse_data(response):
+                raw_bytes = parse_payload_bytes(data)
+                if not raw_bytes:
+                    logger.debug("跳过无法解析的SSE数据块（非hex/base64或不完整）")
+                    continue
+                # Fast path: an event sets exactly one member of ResponseEvent's `type` oneof, so its
+                # first tag byte identifies it; only init/client_actions affect the returned values.
+                # Taken when INFO is disabled, e.g. WARP_LOG_LEVEL=WARNING
+                if raw_bytes[:1] not in _STATEFUL_EVENT_TAGS and not log_info:
+                    event_count += 1
+                    continue
+                try:
+                    msg = _response_event_cls().FromString(raw_bytes)
+                except DecodeError as parse_error:
+                    logger.debug("解析事件失败，跳过: %.100s", parse_error)
+                    continue
+                event_count += 1
+
+                # The event type label is only used for logging here
+                if log_info:
+                    logger.info("🔄 Event #%d: %s", event_count, _event_type_from_msg(msg))
+                if show_all_events and log_debug:
+                    # Full dict conversion is only needed for the verbose event dump
+                    event_data = message_to_dict(msg)
+                    logger.debug("   📋 Event data: %s", _format_event_for_debug(event_data))
+
+                kind = msg.WhichOneof("type")
+                if kind == "init":
+                    conversation_id = msg.init.conversation_id or conversation_id
+                    logger.info(f"会话初始化: {conversation_id}")
+                elif kind == "client_actions":
+                    for i, action in enumerate(msg.client_actions.actions):
+                        which = action.WhichOneof("action")
+                        if log_debug:
+                            logger.debug("   🎯 Action #%d: %s", i + 1, which)
+                        if which == "append_to_message_content":
+                            text_content = action.append_to_message_content.message.agent_output.text
+                            if text_content:
+                                complete_response.write(text_content)
+                                logger.info("   📝 Text Fragment: %.100s...", text_content)
+                        elif which == "add_messages_to_task":
+                            messages_data = action.add_messages_to_task
+                            task_id = messages_data.task_id or task_id
+                            for j, message in enumerate(messages_data.messages):
+                                if log_debug:
+                                    logger.debug("   📨 Message #%d: %s", j + 1, message.WhichOneof("message"))
+                                if message.HasField("agent_output"):
+                                    text_content = message.agent_output.text
+                                    if text_content:
+                                        complete_response.write(text_content)
+                                        logger.info("   📝 Complete Message: %.100s...", text_content)
+            
+            full_response = complete_response.getvalue()
+            logger.info(
+                "%s\n📊 SSE STREAM SUMMARY\n%s\n📈 Total Events Processed: %d\n🆔 Conversation ID: %s\n"
+                "🆔 Task ID: %s\n📝 Response Length: %d characters\n%s",
+                _RULE, _RULE, event_count, conversation_id, task_id, len(full_response), _RULE,
+            )
+            if full_response:
+                logger.info(f"✅ Stream processing completed successfully")
+                return full_response, conversation_id, task_id
+            else:
+                logger.warning("⚠️ No text content received in response")
+                return "Warning: No response content received", conversation_id, task_id
     except Exception as e:
-        import traceback
-        logger.error("="*60)
-        logger.error("WARP API CLIENT EXCEPTION")
-        logger.error("="*60)
-        logger.error(f"Exception Type: {type(e).__name__}")
-        logger.error(f"Exception Message: {str(e)}")
-        logger.error(f"Request URL: {warp_url if 'warp_url' in locals() else 'Unknown'}")
-        logger.error(f"Request Size: {len(protobuf_bytes) if 'protobuf_bytes' in locals() else 'Unknown'}")
-        logger.error("Python Traceback:")
-        logger.error(traceback.format_exc())
-        logger.error("="*60)
+        _log_client_exception(e, "", warp_url if 'warp_url' in locals() else 'Unknown', len(protobuf_bytes))
         raise
 
 
+def _iter_text_fragments(action: dict) -> Iterator[str]:
+    """Yield the agent_output text carried by one parsed ClientAction dict.
+
+    append_to_message_content carries a single message and add_messages_to_task a
+    list of them; both are read through the same agent_output lookup.
+    """
+    append_data = action.get("append_to_message_content")
+    if isinstance(append_data, dict):
+        messages = (append_data.get("message") or {},)
+    else:
+        messages_data = action.get("add_messages_to_task")
+        if not isinstance(messages_data, dict):
+            return
+        messages = messages_data.get("messages") or ()
+    for message in messages:
+        agent_output = message.get("agent_output")
+        if agent_output and (text := agent_output.get("text")):
+            yield text
+
+
+# Events decoded per worker-thread hop in the parsed variant
+_DECODE_BATCH = 8
+
+
+def _decode_events(batch: List[bytes]) -> List[Dict]:
+    """将一批ResponseEvent字节解码为字典，跳过无法解码的事件"""
+    cls = _response_event_cls()
+    decoded = []
+    for raw_bytes in batch:
+        try:
+            event_data = message_to_dict(cls.FromString(raw_bytes))
+        except (DecodeError, json_format.Error, TypeError, ValueError) as parse_err:
+            # Skip only this event; an exception escaping to_thread would drop the whole batch
+            logger.debug("解析事件失败，跳过: %.100s", parse_err)
+            continue
+        decoded.append(event_data)
+    return decoded
+
+
+async def _iter_decoded_events(response: httpx.Response) -> AsyncIterator[Dict]:
+    """按批在线程中解码SSE事件，让事件循环在解码期间继续读取网络数据"""
+    pending: List[bytes] = []
+    async for data in iter_sse_data(response):
+        raw_bytes = parse_payload_bytes(data)
+        if not raw_bytes:
+            logger.debug("跳过无法解析的SSE数据块（非hex/base64或不完整）")
+            continue
+        pending.append(raw_bytes)
+        if len(pending) >= _DECODE_BATCH:
+            batch, pending = pending, []
+            for event_data in await asyncio.to_thread(_decode_events, batch):
+                yield event_data
+    if pending:
+        for event_data in await asyncio.to_thread(_decode_events, pending):
+            yield event_data
+
+
 async def send_protobuf_to_warp_api_parsed(protobuf_bytes: bytes) -> tuple[str, Optional[str], Optional[str], list]:
     """发送protobuf数据到Warp API并获取解析后的SSE事件数据"""
     try:
         logger.info(f"发送 {len(protobuf_bytes)} 字节到Warp API (解析模式)")
-        logger.info(f"数据包前32字节 (hex): {protobuf_bytes[:32].hex()}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("数据包前32字节 (hex): %s", protobuf_bytes[:32].hex())
         
         warp_url = CONFIG_WARP_URL
         
@@ -377,295 +338,61 @@ async def send_protobuf_to_warp_api_parsed(protobuf_bytes: bytes) -> tuple[str,
         
         conversation_id = None
         task_id = None
-        complete_response = []
+        complete_response = io.StringIO()
         parsed_events = []
         event_count = 0
         
-        verify_opt = True
-        insecure_env = os.getenv("WARP_INSECURE_TLS", "").lower()
-        if insecure_env in ("1", "true", "yes"):
-            verify_opt = False
-            logger.warning("TLS verification disabled via WARP_INSECURE_TLS for Warp API client")
-
-        async with httpx.AsyncClient(http2=True, timeout=httpx.Timeout(60.0), verify=verify_opt, trust_env=True) as client:
-            # 最多尝试两次：第一次失败且为配额429时申请匿名token并重试一次
-            current_token_refresh = None  # Track which refresh token is being used
-            current_token_info = None  # Track current TokenInfo object
-
-            # 第一次请求：从token pool获取token
-            if True:  # Always use token pool
-                pool = await get_token_pool()
-                current_token_info = await pool.get_next_token()
-                if current_token_info:
-                    # 检查JWT是否有效，如果无效则刷新
-                    if current_token_info.last_jwt and current_token_info.last_jwt_expiry > time.time() + 120:
-                        # JWT有效且未过期（至少还有2分钟）
-                        jwt = current_token_info.last_jwt
-                        logger.info(f"🎯 使用token pool中的token (解析模式): {current_token_info.name} (优先级: {current_token_info.priority.name}, 使用缓存JWT)")
-                    else:
-                        # JWT无效或即将过期，需要刷新
-                        logger.info(f"🔄 刷新token pool中的token (解析模式): {current_token_info.name}")
-                        from ..core.auth import refresh_jwt_token_with_token_info
-                        token_data = await refresh_jwt_token_with_token_info(current_token_info)
-                        if token_data and "access_token" in token_data:
-                            jwt = token_data["access_token"]
-                            logger.info(f"✅ Token刷新成功 (解析模式): {current_token_info.name}")
-                        else:
-                            logger.error(f"❌ Token刷新失败，使用环境变量中的JWT (解析模式)")
-                            jwt = await get_valid_jwt()
-
-                    current_token_refresh = current_token_info.refresh_token
-                else:
-                    # Fallback to old method if pool is empty
-                    jwt = await get_valid_jwt()
-                    logger.warning("⚠️ Token pool为空，使用环境变量中的JWT (解析模式)")
-
-            for attempt in range(2):
-                headers = {
-                    "accept": "text/event-stream",
-                    "content-type": "application/x-protobuf", 
-                    "x-warp-client-version": "v0.2025.08.06.08.12.stable_02",
-                    "x-warp-os-category": "Windows",
-                    "x-warp-os-name": "Windows", 
-                    "x-warp-os-version": "11 (26100)",
-                    "authorization": f"Bearer {jwt}",
-                    "content-length": str(len(protobuf_bytes)),
-                }
-                async with client.stream("POST", warp_url, headers=headers, content=protobuf_bytes) as response:
-                    if response.status_code != 200:
-                        error_text = await response.aread()
-                        error_content = error_text.decode('utf-8') if error_text else "No error content"
-
-                        # 记录详细的错误信息
-                        logger.error(f"❌ Warp API返回错误状态码: {response.status_code}")
-                        logger.error(f"   错误内容: {error_content[:500]}")
-                        logger.error(f"   响应头: {dict(response.headers)}")
-                        logger.error(f"   请求大小: {len(protobuf_bytes)} 字节")
-                        logger.error(f"   尝试次数: {attempt + 1}/2")
-
-                        # 检测配额耗尽错误并在第一次失败时尝试使用token pool中的下一个token
-                        if response.status_code == 429 and attempt == 0 and (
-                            ("No remaining quota" in error_content) or ("No AI requests remaining" in error_content)
-                        ):
-                            logger.warning("⚠️ WARP API 返回 429 (配额用尽, 解析模式)。尝试从token pool获取下一个token并重试…")
-                            try:
-                                # 尝试从token pool获取下一个可用token（排除当前失败的token）
-                                pool = await get_token_pool()
-
-                                # 显示当前token pool状态
-                                pool_stats = await pool.get_pool_stats()
-                                logger.info(f"📊 Token pool状态 (解析模式): 总数={pool_stats['total_tokens']}, 活跃={pool_stats['active_tokens']}, 匿名={pool_stats['anonymous_tokens']}, 个人={pool_stats['personal_tokens']}")
-
-                                # 如果current_token_refresh为None，尝试获取最后使用的token
-                                if current_token_refresh is None:
-                                    last_used = pool.get_last_used_token()
-                                    if last_used:
-                                        current_token_refresh = last_used.refresh_token
-                                        logger.info(f"🔍 检测到最后使用的token (解析模式): {last_used.name} (last_used={last_used.last_used})")
-                                    else:
-                                        logger.warning("⚠️ 无法检测到最后使用的token (解析模式)")
-                                else:
-                                    logger.info(f"🔍 当前使用的token (解析模式): {current_token_refresh[:20]}...")
-
-                                logger.info(f"🔄 尝试获取下一个token (解析模式, 排除: {current_token_refresh[:20] if current_token_refresh else 'None'}...)")
-                                token_info = await pool.get_next_token_excluding(current_token_refresh)
-                                logger.info(f"🔍 get_next_token_excluding返回 (解析模式): {token_info.name if token_info else 'None'}")
-
-                                if not token_info:
-                                    # 没有其他token了，尝试申请新的匿名token
-                                    logger.warning("⚠️ Token pool中没有其他可用token，尝试申请新的匿名token…")
-                                    try:
-                                        new_jwt = await acquire_anonymous_access_token()
-                                        if new_jwt:
-                                            logger.info("✅ 成功申请新的匿名token (解析模式)")
-                                            jwt = new_jwt
-                                            current_token_refresh = None  # New anonymous token
-                                            continue
-                                    except Exception as anon_err:
-                                        logger.error(f"❌ 申请匿名token失败: {anon_err}")
-
-                                    logger.error("❌ 所有token尝试失败")
-                                    logger.error(f"WARP API HTTP ERROR (解析模式) {response.status_code}: {error_content}")
-                                    return f"❌ Warp API Error (HTTP {response.status_code}): {error_content}", None, None, []
-
-                                if token_info and token_info.last_jwt:
-                                    # 使用缓存的JWT
-                                    logger.info(f"✅ 使用token pool中的下一个token: {token_info.name} (解析模式)")
-                                    jwt = token_info.last_jwt
-                                    current_token_refresh = token_info.refresh_token  # Track current token
-                                    continue
-                                elif token_info:
-                                    # 需要刷新JWT
-                                    logger.info(f"🔄 刷新token pool中的token: {token_info.name} (解析模式)")
-                                    from ..core.auth import refresh_jwt_token_with_token_info
-                                    token_data = await refresh_jwt_token_with_token_info(token_info)
-                                    if token_data and "access_token" in token_data:
-                                        jwt = token_data["access_token"]
-                                        current_token_refresh = token_info.refresh_token  # Track current token
-                                        logger.info(f"✅ Token刷新成功，使用新JWT重试 (解析模式)")
-                                        continue
-
-                                # 如果token pool中没有可用token，尝试申请匿名token作为最后手段
-                                logger.warning("⚠️ Token pool中没有可用token，尝试申请匿名token作为后备… (解析模式)")
-                                new_jwt = await acquire_anonymous_access_token()
-                                if new_jwt:
-                                    jwt = new_jwt
-                                    continue
-
-                            except Exception as e:
-                                logger.error(f"❌ Token pool处理失败 (解析模式): {e}")
-
-                            # 如果到这里，说明所有尝试都失败了
-                            logger.error(f"WARP API HTTP ERROR (解析模式) {response.status_code}: {error_content}")
-                            return f"❌ Warp API Error (HTTP {response.status_code}): {error_content}", None, None, []
-
-                        # 特殊处理500错误 - 可能是token问题，尝试切换token
-                        if response.status_code == 500 and attempt == 0:
-                            logger.warning("⚠️ WARP API 返回 500 (服务器错误)。尝试切换到下一个token重试…")
-                            try:
-                                pool = await get_token_pool()
-
-                                # 如果current_token_refresh为None，尝试获取最后使用的token
-                                if current_token_refresh is None:
-                                    last_used = pool.get_last_used_token()
-                                    if last_used:
-                                        current_token_refresh = last_used.refresh_token
-                                        logger.info(f"🔍 检测到最后使用的token: {last_used.name}")
-
-                                # 获取下一个token（排除当前失败的token）
-                                token_info = await pool.get_next_token_excluding(current_token_refresh)
-
-                                if token_info:
-                                    logger.info(f"🔄 切换到token: {token_info.name}")
-                                    current_token_refresh = token_info.refresh_token  # 更新当前token
-                                    from ..core.auth import refresh_jwt_token_with_token_info
-                                    token_data = await refresh_jwt_token_with_token_info(token_info)
-                                    if token_data and "access_token" in token_data:
-                                        jwt = token_data["access_token"]
-                                        logger.info(f"✅ 使用新token重试")
-                                        continue
-                            except Exception as e:
-                                logger.error(f"❌ 切换token失败: {e}")
-
-                        # 其他错误或第二次失败
-                        logger.error(f"WARP API HTTP ERROR (解析模式) {response.status_code}: {error_content}")
-                        return f"❌ Warp API Error (HTTP {response.status_code}): {error_content}", None, None, []
-                    
-                    logger.info(f"✅ 收到HTTP {response.status_code}响应 (解析模式)")
-                    logger.info("开始处理SSE事件流...")
-                    
-                    import re as _re2
-                    def _parse_payload_bytes2(data_str: str):
-                        s = _re2.sub(r"\s+", "", data_str or "")
-                        if not s:
-                            return None
-                        if _re2.fullmatch(r"[0-9a-fA-F]+", s or ""):
-                            try:
-                                return bytes.fromhex(s)
-                            except Exception:
-                                pass
-                        pad = "=" * ((4 - (len(s) % 4)) % 4)
-                        try:
-                            import base64 as _b642
-                            return _b642.urlsafe_b64decode(s + pad)
-                        except Exception:
-                            try:
-                                return _b642.b64decode(s + pad)
-                            except Exception:
-                                return None
-                    
-                    current_data = ""
-                    
-                    async for line in response.aiter_lines():
-                        if line.startswith("data:"):
-                            payload = line[5:].strip()
-                            if not payload:
-                                continue
-                            if payload == "[DONE]":
-                                logger.info("收到[DONE]标记，结束处理")
-                                break
-                            current_data += payload
-                            continue
+        client = await get_client()
+        async with _post_with_token_rotation(client, warp_url, protobuf_bytes, mode=" (解析模式)") as (response, error):
+            if error is not None:
+                return error, None, None, []
+
+            logger.info("开始处理SSE事件流...")
+            # Resolve log levels once per stream instead of per event/action
+            log_info = logger.isEnabledFor(logging.INFO)
+            log_debug = logger.isEnabledFor(logging.DEBUG)
+
+            async for event_data in _iter_decoded_events(response):
+                try:
+                    event_count += 1
+                    event_type = _get_event_type(event_data)
+                    parsed_event = {"event_number": event_count, "event_type": event_type, "parsed_data": event_data}
+                    parsed_events.append(parsed_event)
+                    logger.info("🔄 Event #%d: %s", event_count, event_type)
+                    if log_debug:
+                        logger.debug("   📋 Event data: %s", _format_event_for_debug(event_data))
+
+                    if "init" in event_data:
+                        init_data = event_data["init"]
+                        conversation_id = init_data.get("conversation_id", conversation_id)
+                        task_id = init_data.get("task_id", task_id)
+                        logger.info(f"会话初始化: {conversation_id}")
                         
-                        if (line.strip() == "") and current_data:
-                            raw_bytes = _parse_payload_bytes2(current_data)
-                            current_data = ""
-                            if raw_bytes is None:
-                                logger.debug("跳过无法解析的SSE数据块（非hex/base64或不完整）")
-                                continue
-                            try:
-                                event_data = protobuf_to_dict(raw_bytes, "warp.multi_agent.v1.ResponseEvent")
-                                event_count += 1
-                                event_type = _get_event_type(event_data)
-                                parsed_event = {"event_number": event_count, "event_type": event_type, "parsed_data": event_data}
-                                parsed_events.append(parsed_event)
-                                logger.info(f"🔄 Event #{event_count}: {event_type}")
-                                logger.debug(f"   📋 Event data: {str(event_data)}...")
-                                
-                                def _get(d: Dict[str, Any], *names: str) -> Any:
-                                    for n in names:
-                                        if isinstance(d, dict) and n in d:
-                                            return d[n]
-                                    return None
-                                
-                                if "init" in event_data:
-                                    init_data = event_data["init"]
-                                    conversation_id = init_data.get("conversation_id", conversation_id)
-                                    task_id = init_data.get("task_id", task_id)
-                                    logger.info(f"会话初始化: {conversation_id}")
-                                
-                                client_actions = _get(event_data, "client_actions", "clientActions")
-                                if isinstance(client_actions, dict):
-                                    actions = _get(client_actions, "actions", "Actions") or []
-                                    for i, action in enumerate(actions):
-                                        logger.info(f"   🎯 Action #{i+1}: {list(action.keys())}")
-                                        append_data = _get(action, "append_to_message_content", "appendToMessageContent")
-                                        if isinstance(append_data, dict):
-                                            message = append_data.get("message", {})
-                                            agent_output = _get(message, "agent_output", "agentOutput") or {}
-                                            text_content = agent_output.get("text", "")
-                                            if text_content:
-                                                complete_response.append(text_content)
-                                                logger.info(f"   📝 Text Fragment: {text_content[:100]}...")
-                                        messages_data = _get(action, "add_messages_to_task", "addMessagesToTask")
-                                        if isinstance(messages_data, dict):
-                                            messages = messages_data.get("messages", [])
-                                            task_id = messages_data.get("task_id", messages_data.get("taskId", task_id))
-                                            for j, message in enumerate(messages):
-                                                logger.info(f"   📨 Message #{j+1}: {list(message.keys())}")
-                                                if _get(message, "agent_output", "agentOutput") is not None:
-                                                    agent_output = _get(message, "agent_output", "agentOutput") or {}
-                                                    text_content = agent_output.get("text", "")
-                                                    if text_content:
-                                                        complete_response.append(text_content)
-                                                        logger.info(f"   📝 Complete Message: {text_content[:100]}...")
-                            except Exception as parse_err:
-                                logger.debug(f"解析事件失败，跳过: {str(parse_err)[:100]}")
-                                continue
-                    
-                    full_response = "".join(complete_response)
-                    logger.info("="*60)
-                    logger.info("📊 SSE STREAM SUMMARY (解析模式)")
-                    logger.info("="*60)
-                    logger.info(f"📈 Total Events Processed: {event_count}")
-                    logger.info(f"🆔 Conversation ID: {conversation_id}")
-                    logger.info(f"🆔 Task ID: {task_id}")
-                    logger.info(f"📝 Response Length: {len(full_response)} characters")
-                    logger.info(f"🎯 Parsed Events Count: {len(parsed_events)}")
-                    logger.info("="*60)
-                    
-                    logger.info(f"✅ Stream processing completed successfully (解析模式)")
-                    return full_response, conversation_id, task_id, parsed_events
+                    client_actions = event_data.get("client_actions")
+                    if isinstance(client_actions, dict):
+                        actions = client_actions.get("actions") or []
+                        for i, action in enumerate(actions):
+                            if log_debug:
+                                logger.debug("   🎯 Action #%d: %s", i + 1, list(action.keys()))
+                            messages_data = action.get("add_messages_to_task")
+                            if isinstance(messages_data, dict):
+                                task_id = messages_data.get("task_id", task_id)
+                            for text_content in _iter_text_fragments(action):
+                                complete_response.write(text_content)
+                                logger.info("   📝 Text Fragment: %.100s...", text_content)
+                except (KeyError, TypeError, AttributeError) as parse_err:
+                    logger.debug("处理事件失败，跳过: %.100s", parse_err)
+                    continue
+            
+            full_response = complete_response.getvalue()
+            logger.info(
+                "%s\n📊 SSE STREAM SUMMARY (解析模式)\n%s\n📈 Total Events Processed: %d\n🆔 Conversation ID: %s\n"
+                "🆔 Task ID: %s\n📝 Response Length: %d characters\n🎯 Parsed Events Count: %d\n%s",
+                _RULE, _RULE, event_count, conversation_id, task_id, len(full_response), len(parsed_events), _RULE,
+            )
+            
+            logger.info(f"✅ Stream processing completed successfully (解析模式)")
+            return full_response, conversation_id, task_id, parsed_events
     except Exception as e:
-        import traceback
-        logger.error("="*60)
-        logger.error("WARP API CLIENT EXCEPTION (解析模式)")
-        logger.error("="*60)
-        logger.error(f"Exception Type: {type(e).__name__}")
-        logger.error(f"Exception Message: {str(e)}")
-        logger.error(f"Request URL: {warp_url if 'warp_url' in locals() else 'Unknown'}")
-        logger.error(f"Request Size: {len(protobuf_bytes) if 'protobuf_bytes' in locals() else 'Unknown'}")
-        logger.error("Python Traceback:")
-        logger.error(traceback.format_exc())
-        logger.error("="*60)
+        _log_client_exception(e, " (解析模式)", warp_url if 'warp_url' in locals() else 'Unknown', len(protobuf_bytes))
         raise
\ No newline at end of file
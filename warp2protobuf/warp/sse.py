@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Warp SSE数据解析辅助模块
+
+Warp以hex或base64编码的protobuf作为SSE data负载，供api_client与SSE代理端点共用。
+"""
+import base64
+import binascii
+from typing import AsyncIterator, List, Optional, Union
+
+import httpx
+
+from ..core.logging import logger
+
+
+# Whitespace stripped from SSE payloads before hex/base64 decoding
+_WS_BYTES = b" \t\r\n\v\f"
+
+
+def parse_payload_bytes(data: Union[bytes, str]) -> Optional[bytes]:
+    """Decode an SSE data payload that may be hex or (urlsafe) base64 encoded"""
+    if isinstance(data, str):
+        try:
+            data = data.encode("ascii")
+        except UnicodeEncodeError:
+            return None  # neither hex nor base64
+    s = (data or b"").translate(None, _WS_BYTES)
+    if not s:
+        return None
+    # unhexlify validates in one C pass; no separate hex-only regex check needed
+    try:
+        return binascii.unhexlify(s)
+    except binascii.Error:
+        pass
+    pad = b"=" * (-len(s) % 4)
+    try:
+        return base64.urlsafe_b64decode(s + pad)
+    except binascii.Error:
+        try:
+            return base64.b64decode(s + pad)
+        except binascii.Error:
+            return None
+
+
+async def iter_sse_data(response: httpx.Response) -> AsyncIterator[bytes]:
+    """Yield the joined `data:` payload of each SSE event, stopping at [DONE]"""
+    buf = bytearray()
+    parts: List[bytearray] = []
+    async for chunk in response.aiter_bytes(65536):
+        buf.extend(chunk)
+        start = 0
+        while (end := buf.find(b"\n", start)) != -1:
+            line_start, start = start, end + 1
+            # Match and slice inside buf directly: one copy per data line, none for other lines
+            if buf.startswith(b"data:", line_start, end):
+                payload = buf[line_start + 5:end].strip()  # also drops a trailing \r
+                if not payload:
+                    continue
+                if payload == b"[DONE]":
+                    logger.info("收到[DONE]标记，结束处理")
+                    return
+                parts.append(payload)
+            elif parts and not buf[line_start:end].strip():
+                # Blank line terminates the event; join its data lines once
+                data = b"".join(parts)
+                parts = []
+                yield data
+        del buf[:start]